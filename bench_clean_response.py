@@ -0,0 +1,109 @@
+# Micro-benchmark for clean_response on realistic ~2,000 character Gemini replies.
+# Compares the current single-pass sanitizer with the original per-line regex version.
+#
+# Usage: python bench_clean_response.py [iterations]
+import logging
+import re
+import sys
+import timeit
+
+from bot import clean_response
+
+# The sanitizer as it was before patterns were precompiled, kept here for comparison
+def legacy_clean_response(response_text):
+    if re.search(r'\[\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}\]', response_text):
+        lines = response_text.split('\n')
+        cleaned_lines = []
+        skip_line = False
+        for line in lines:
+            if re.search(r'\[\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}\]', line):
+                skip_line = True
+                continue
+            if re.search(r'\[.*\] (USER|BOT):', line):
+                skip_line = True
+                continue
+            if any(marker in line.lower() for marker in [
+                "conversation history",
+                "chat history",
+                "previous messages",
+                "our conversation",
+                "earlier conversation",
+                "from our previous"
+            ]):
+                skip_line = True
+                continue
+            if skip_line and not line.strip():
+                skip_line = False
+                continue
+            if not skip_line:
+                cleaned_lines.append(line)
+
+        if not cleaned_lines or "".join(cleaned_lines).strip() == "":
+            parts = re.split(r'\[\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}\].*?(?=\n|$)', response_text)
+            if parts and parts[-1].strip():
+                cleaned_response = parts[-1].strip()
+            else:
+                cleaned_response = "I understand your message, but I'm having trouble formulating a proper response. Could you try asking again in a different way?"
+        else:
+            cleaned_response = "\n".join(cleaned_lines)
+
+        return cleaned_response.strip()
+
+    return response_text
+
+# Repeat paragraphs until the text is about `length` characters long
+def build_reply(paragraphs, length=2000):
+    text = ""
+    index = 0
+    while len(text) < length:
+        text += paragraphs[index % len(paragraphs)] + "\n\n"
+        index += 1
+    return text[:length]
+
+chatty_paragraphs = [
+    "omg yes!! 😄 pizza is honestly the best comfort food, no debate. i'm a pineapple person tho, don't judge me lol",
+    "ngl the weekend went way too fast. spent most of saturday trying to fix my bike and sunday just binge-watching stuff",
+    "if you're looking for something to watch, try the new season of that space show everyone keeps talking about. "
+    "the first two episodes are kinda slow but it really picks up after that, trust me 🚀",
+    "- grab snacks\n- turn off your phone\n- thank me later",
+    "anyway how's your week going? still stressing about that exam or did it turn out okay?",
+]
+
+echo_paragraphs = [
+    "[2024-05-01 18:22:10] [Server: Hangout, Channel: airi-chatting (Airi channel)] USER: what should i eat tonight",
+    "[2024-05-01 18:22:14] [Server: Hangout, Channel: airi-chatting (Airi channel)] BOT: pizza, obviously 🍕",
+    "Based on our conversation history, you really like pizza.",
+    "honestly though, go for tacos tonight! switching it up is good for the soul 🌮 and you can always do pizza friday",
+    "let me know what you end up picking!",
+]
+
+cases = {
+    "plain reply": build_reply(chatty_paragraphs),
+    "reply echoing log lines": build_reply(echo_paragraphs),
+    "reply that is only log lines": build_reply(echo_paragraphs[:2]),
+}
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    # clean_response logs a warning whenever it cleans a reply; keep the output readable
+    logging.getLogger("bot").setLevel(logging.ERROR)
+    
+    mismatches = [name for name, text in cases.items() if clean_response(text) != legacy_clean_response(text)]
+    if mismatches:
+        print(f"Output differs from the original sanitizer for: {', '.join(mismatches)}")
+        sys.exit(1)
+
+    print(f"clean_response benchmark ({iterations} iterations per case)")
+    for name, text in cases.items():
+        current = timeit.timeit(lambda: clean_response(text), number=iterations)
+        legacy = timeit.timeit(lambda: legacy_clean_response(text), number=iterations)
+        print(
+            f"  {name:<30} {len(text):>5} chars   "
+            f"current {current / iterations * 1e6:8.1f} us   "
+            f"original {legacy / iterations * 1e6:8.1f} us   "
+            f"{legacy / current:5.2f}x"
+        )
+
+if __name__ == "__main__":
+    main()
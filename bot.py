@@ -2,457 +2,2119 @@ import os
 import discord
 import random
 import aiohttp
-import requests
+from aiohttp import web
 import google.generativeai as genai
 from discord import app_commands
 from dotenv import load_dotenv
 import traceback
+import sys
+import logging
+import logging.handlers
+import queue
+import copy
+import atexit
+import subprocess
+import signal
 from datetime import datetime
 import asyncio
 import pathlib
 import re
-
-print("Starting Discord bot initialization...")
+import io
+import sqlite3
+import threading
+import time
+import bisect
+import json
+import hashlib
+import contextlib
+import zlib
+import math
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 # Create logs directory if it doesn't exist
 logs_dir = pathlib.Path("logs")
 logs_dir.mkdir(exist_ok=True)
 
 # Load environment variables
-print("Loading environment variables...")
 load_dotenv()
 TOKEN = os.getenv('DISCORD_TOKEN')
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 HUGGINGFACE_API_KEY = os.getenv('HUGGINGFACE_API_KEY')
 OPENWEATHER_API_KEY = os.getenv('OPENWEATHER_API_KEY')
 
-# Debug prints for troubleshooting
-print(f"Discord Token loaded: {'Yes' if TOKEN else 'No'}")
-print(f"Gemini API Key loaded: {'Yes' if GEMINI_API_KEY else 'No'}")
-print(f"Hugging Face API Key loaded: {'Yes' if HUGGINGFACE_API_KEY else 'No'}")
-print(f"OpenWeather API Key loaded: {'Yes' if OPENWEATHER_API_KEY else 'No'}")
-print(f"Hugging Face API Key value: {HUGGINGFACE_API_KEY[:4]}...{HUGGINGFACE_API_KEY[-4:] if HUGGINGFACE_API_KEY and len(HUGGINGFACE_API_KEY) > 8 else '(too short)'}")
+# Logging: LOG_FORMAT is "json" (one object per line) or "text"; LOG_DEBUG_SAMPLE_RATE keeps that share of
+# debug messages when LOG_LEVEL is DEBUG
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json').lower()
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv('LOG_DEBUG_SAMPLE_RATE', '1.0'))
+
+# Attributes every LogRecord has; anything else was passed through `extra=` and is logged as a field
+standard_record_attributes = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+# Replaces the bot's tokens and API keys, and any bearer token, wherever they appear in log output
+class SecretRedactor:
+    def __init__(self, secrets):
+        self.secrets = sorted((secret for secret in secrets if secret and len(secret) >= 8), key=len, reverse=True)
+        self.bearer_pattern = re.compile(r"(Bearer\s+)[\w.~+/=-]+", re.IGNORECASE)
+    
+    def redact(self, text):
+        for secret in self.secrets:
+            if secret in text:
+                text = text.replace(secret, "[REDACTED]")
+        return self.bearer_pattern.sub(r"\1[REDACTED]", text)
+
+redactor = SecretRedactor([TOKEN, GEMINI_API_KEY, HUGGINGFACE_API_KEY, OPENWEATHER_API_KEY])
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created).astimezone().isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in standard_record_attributes:
+                entry[key] = value
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return redactor.redact(json.dumps(entry, default=str, ensure_ascii=False))
+
+class TextLogFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)-7s %(name)s: %(message)s")
+    
+    def format(self, record):
+        text = super().format(record)
+        fields = " ".join(f"{key}={value}" for key, value in vars(record).items() if key not in standard_record_attributes)
+        return redactor.redact(f"{text} {fields}" if fields else text)
+
+# Keeps a random LOG_DEBUG_SAMPLE_RATE share of debug messages, and everything above debug
+class DebugSampler(logging.Filter):
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+    
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or self.rate >= 1 or random.random() < self.rate
+
+# Hands records to the listener thread without formatting them, so exceptions stay separate fields
+class LogQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+# Log from the bot and discord.py through a queue; a background thread does the formatting and writing
+def setup_logging():
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(TextLogFormatter() if LOG_FORMAT == "text" else JsonLogFormatter())
+    
+    log_queue = queue.SimpleQueue()
+    queue_handler = LogQueueHandler(log_queue)
+    queue_handler.addFilter(DebugSampler(LOG_DEBUG_SAMPLE_RATE))
+    
+    for name in ("bot", "discord"):
+        logger = logging.getLogger(name)
+        logger.addHandler(queue_handler)
+        logger.propagate = False
+    logging.getLogger("bot").setLevel(LOG_LEVEL)
+    logging.getLogger("discord").setLevel(max(logging.getLevelName(LOG_LEVEL), logging.INFO))
+    
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+setup_logging()
+log = logging.getLogger("bot")
+chat_log = logging.getLogger("bot.chat")
+gemini_log = logging.getLogger("bot.gemini")
+store_log = logging.getLogger("bot.store")
+commands_log = logging.getLogger("bot.commands")
+imgen_log = logging.getLogger("bot.imgen")
+weather_log = logging.getLogger("bot.weather")
+breaker_log = logging.getLogger("bot.breaker")
+metrics_log = logging.getLogger("bot.metrics")
+watchdog_log = logging.getLogger("bot.watchdog")
+games_log = logging.getLogger("bot.games")
+
+log.info("Starting Discord bot initialization...")
+log.info(
+    "Configuration loaded",
+    extra={
+        "discord_token": bool(TOKEN),
+        "gemini_api_key": bool(GEMINI_API_KEY),
+        "huggingface_api_key": bool(HUGGINGFACE_API_KEY),
+        "openweather_api_key": bool(OPENWEATHER_API_KEY),
+    }
+)
+
+# Gemini generation limits: how many completions may run at once and how long each may take
+GEMINI_MAX_CONCURRENCY = int(os.getenv('GEMINI_MAX_CONCURRENCY', '4'))
+GEMINI_TIMEOUT = float(os.getenv('GEMINI_TIMEOUT', '30'))
+
+# Conversation context budget: how much history is sent to Gemini with each message
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '1500'))
+CONTEXT_SUMMARY = os.getenv('CONTEXT_SUMMARY', 'true').lower() == 'true'
+CONTEXT_SUMMARY_TOKENS = int(os.getenv('CONTEXT_SUMMARY_TOKENS', '150'))
+
+# Conversation store: SQLite database holding every logged message, and how many turns to load per user
+CONVERSATION_DB_PATH = os.getenv('CONVERSATION_DB_PATH', str(logs_dir / "conversations.db"))
+CONVERSATION_HISTORY_TURNS = int(os.getenv('CONVERSATION_HISTORY_TURNS', '200'))
+
+# Background log writer: messages are written in batches once either threshold is reached
+LOG_WRITER_BATCH_SIZE = int(os.getenv('LOG_WRITER_BATCH_SIZE', '100'))
+LOG_WRITER_FLUSH_INTERVAL = float(os.getenv('LOG_WRITER_FLUSH_INTERVAL', '1.0'))
+
+# In-memory cache of recent conversation turns per user
+CONVERSATION_CACHE_MAX_CHARS = int(os.getenv('CONVERSATION_CACHE_MAX_CHARS', '20000000'))
+CONVERSATION_CACHE_USER_CHARS = int(os.getenv('CONVERSATION_CACHE_USER_CHARS', str(CONTEXT_TOKEN_BUDGET * 16)))
+CONVERSATION_CACHE_IDLE_SECONDS = float(os.getenv('CONVERSATION_CACHE_IDLE_SECONDS', '1800'))
+
+# Stream Gemini replies into Discord as they are generated, editing the message at most once per interval
+STREAM_RESPONSES = os.getenv('STREAM_RESPONSES', 'true').lower() == 'true'
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.0'))
+
+# Replies longer than this are sent as a text file instead of a series of messages
+LONG_REPLY_ATTACHMENT_CHARS = int(os.getenv('LONG_REPLY_ATTACHMENT_CHARS', '6000'))
+
+# Seconds to wait for more messages from the same user in the same channel before replying to them together
+COALESCE_WINDOW = float(os.getenv('COALESCE_WINDOW', '1.0'))
+# On shutdown, seconds to let chat replies already in progress finish before cancelling them
+CHAT_DRAIN_TIMEOUT = float(os.getenv('CHAT_DRAIN_TIMEOUT', '10'))
+
+# AI admission control: token buckets refilled at these rates (requests per minute) with these burst sizes
+AI_USER_RATE = float(os.getenv('AI_USER_RATE', '6'))
+AI_USER_BURST = int(os.getenv('AI_USER_BURST', '3'))
+AI_GUILD_RATE = float(os.getenv('AI_GUILD_RATE', '30'))
+AI_GUILD_BURST = int(os.getenv('AI_GUILD_BURST', '10'))
+AI_GLOBAL_RATE = float(os.getenv('AI_GLOBAL_RATE', '120'))
+AI_GLOBAL_BURST = int(os.getenv('AI_GLOBAL_BURST', '20'))
+
+# Shared HTTP connection pool used by the image and meme commands
+HTTP_MAX_CONNECTIONS = int(os.getenv('HTTP_MAX_CONNECTIONS', '100'))
+HTTP_MAX_CONNECTIONS_PER_HOST = int(os.getenv('HTTP_MAX_CONNECTIONS_PER_HOST', '10'))
+HTTP_DNS_CACHE_TTL = int(os.getenv('HTTP_DNS_CACHE_TTL', '300'))
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', '30'))
+
+# Image generation queue: background workers, jobs each user may have waiting, and retry behaviour
+IMGEN_WORKERS = int(os.getenv('IMGEN_WORKERS', '2'))
+IMGEN_MAX_JOBS_PER_USER = int(os.getenv('IMGEN_MAX_JOBS_PER_USER', '2'))
+IMGEN_TIMEOUT = float(os.getenv('IMGEN_TIMEOUT', '90'))
+IMGEN_MAX_RETRIES = int(os.getenv('IMGEN_MAX_RETRIES', '3'))
+IMGEN_RETRY_BASE_DELAY = float(os.getenv('IMGEN_RETRY_BASE_DELAY', '5'))
+IMGEN_RETRY_MAX_DELAY = float(os.getenv('IMGEN_RETRY_MAX_DELAY', '60'))
+# Largest image accepted from Hugging Face (0 for no limit), and whether to check that the bytes really are an image
+IMGEN_MAX_BYTES = int(os.getenv('IMGEN_MAX_BYTES', str(25 * 1024 * 1024)))
+IMGEN_VERIFY_IMAGES = os.getenv('IMGEN_VERIFY_IMAGES', 'true').lower() == 'true'
+
+# Weather cache: how long a city's weather is reused, and how long an unknown city is remembered
+WEATHER_CACHE_TTL = float(os.getenv('WEATHER_CACHE_TTL', '600'))
+WEATHER_NOT_FOUND_TTL = float(os.getenv('WEATHER_NOT_FOUND_TTL', '60'))
+WEATHER_CACHE_SIZE = int(os.getenv('WEATHER_CACHE_SIZE', '1000'))
+WEATHER_TIMEOUT = float(os.getenv('WEATHER_TIMEOUT', '15'))
+
+# /tlme answers are reused for repeated questions; a similarity above 0 also matches near-duplicate questions
+TLME_CACHE_TTL = float(os.getenv('TLME_CACHE_TTL', '3600'))
+TLME_CACHE_SIZE = int(os.getenv('TLME_CACHE_SIZE', '500'))
+TLME_CACHE_SIMILARITY = float(os.getenv('TLME_CACHE_SIMILARITY', '0'))
+
+# Seconds between Gemini health checks while it works, and while it is failing
+GEMINI_HEALTH_INTERVAL = float(os.getenv('GEMINI_HEALTH_INTERVAL', '300'))
+GEMINI_HEALTH_RETRY_INTERVAL = float(os.getenv('GEMINI_HEALTH_RETRY_INTERVAL', '60'))
+
+# Circuit breakers for external services: open after this many failures in a row, or when this share of the
+# last BREAKER_WINDOW calls (at least BREAKER_MIN_CALLS) failed, then probe again after BREAKER_RESET_TIMEOUT seconds
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', '5'))
+BREAKER_ERROR_RATE = float(os.getenv('BREAKER_ERROR_RATE', '0.5'))
+BREAKER_WINDOW = int(os.getenv('BREAKER_WINDOW', '20'))
+BREAKER_MIN_CALLS = int(os.getenv('BREAKER_MIN_CALLS', '10'))
+BREAKER_RESET_TIMEOUT = float(os.getenv('BREAKER_RESET_TIMEOUT', '30'))
+
+# Slash commands are only re-synced when they change; set FORCE_COMMAND_SYNC to sync anyway. DEV_GUILD_IDS
+# (comma-separated server IDs) syncs to those servers instead of globally, for testing command changes.
+COMMAND_SYNC_STATE_PATH = logs_dir / "command_tree_sync.json"
+FORCE_COMMAND_SYNC = os.getenv('FORCE_COMMAND_SYNC', 'false').lower() == 'true'
+DEV_GUILD_IDS = [int(guild_id) for guild_id in os.getenv('DEV_GUILD_IDS', '').split(',') if guild_id.strip()]
+# Set to false on all but one process when several share the same application
+SYNC_COMMANDS = os.getenv('SYNC_COMMANDS', 'true').lower() == 'true'
+
+# Sharding: SHARD_COUNT is the total number of shards ("auto" lets Discord recommend one) and SHARD_IDS the shards
+# this process runs, e.g. "0-3" or "0,2,4" (needs a numeric SHARD_COUNT). SHARD_PROCESSES above 1 starts that many
+# bot processes and splits SHARD_COUNT between them. Processes then share the conversation database and re-check
+# cached history against it.
+SHARD_COUNT = os.getenv('SHARD_COUNT', '').strip().lower()
+SHARD_PROCESSES = int(os.getenv('SHARD_PROCESSES', '1'))
+# Seconds the launcher waits for bot processes to shut down cleanly before killing them
+SHARD_SHUTDOWN_TIMEOUT = float(os.getenv('SHARD_SHUTDOWN_TIMEOUT', '30'))
+CONVERSATION_SHARED_STORE = os.getenv('CONVERSATION_SHARED_STORE', 'false').lower() == 'true'
+
+# Parse "0-3,6" into [0, 1, 2, 3, 6]
+def parse_shard_ids(text):
+    shard_ids = []
+    for part in text.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        start, _, end = part.partition('-')
+        shard_ids.extend(range(int(start), int(end or start) + 1))
+    return shard_ids
+
+SHARD_IDS = parse_shard_ids(os.getenv('SHARD_IDS', ''))
+SHARDED = bool(SHARD_COUNT or SHARD_IDS)
+
+# discord.py can only run some of the shards when it's told how many there are in total
+if SHARD_COUNT not in ('', 'auto') and not SHARD_COUNT.isdigit():
+    log.error("SHARD_COUNT must be a number of shards, \"auto\" or empty, not %r", SHARD_COUNT)
+    sys.exit(1)
+if SHARD_IDS and not SHARD_COUNT.isdigit():
+    log.error("SHARD_IDS needs SHARD_COUNT set to the total number of shards (not empty or \"auto\")")
+    sys.exit(1)
+if SHARD_IDS and max(SHARD_IDS) >= int(SHARD_COUNT):
+    log.error("SHARD_IDS lists shard %d, but SHARD_COUNT is %s (shards are numbered from 0)", max(SHARD_IDS), SHARD_COUNT)
+    sys.exit(1)
+
+# Metrics are served at http://METRICS_HOST:METRICS_PORT/metrics when METRICS_PORT is set, and written to
+# METRICS_DUMP_PATH every METRICS_DUMP_INTERVAL seconds (and on shutdown) when the interval is set
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_DUMP_PATH = os.getenv('METRICS_DUMP_PATH', str(logs_dir / "metrics.prom"))
+METRICS_DUMP_INTERVAL = float(os.getenv('METRICS_DUMP_INTERVAL', '0'))
+EVENT_LOOP_LAG_INTERVAL = float(os.getenv('EVENT_LOOP_LAG_INTERVAL', '0.5'))
+
+# Report the stack and task behind event loop stalls longer than this many seconds (0 = off), and list the
+# worst offenders every WATCHDOG_REPORT_INTERVAL seconds
+WATCHDOG_THRESHOLD = float(os.getenv('WATCHDOG_THRESHOLD', '0.25'))
+WATCHDOG_REPORT_INTERVAL = float(os.getenv('WATCHDOG_REPORT_INTERVAL', '300'))
 
 # Check for placeholder values
 if TOKEN == "your_bot_token_here":
-    print("Error: You need to replace 'your_bot_token_here' with your actual Discord bot token in the .env file")
+    log.error("You need to replace 'your_bot_token_here' with your actual Discord bot token in the .env file")
     exit(1)
 
-# Set up Gemini
-try:
-    genai.configure(api_key=GEMINI_API_KEY)
-    # Set up the model - using gemini-1.5-flash (Gemini 2.0 Flash)
-    gemini_model = genai.GenerativeModel('gemini-2.0-flash')
-    # Test the model with a simple query
-    response = gemini_model.generate_content("Hello")
-    ai_working = True
-    print("Gemini API connection successful using gemini-2.0-flash model")
-except Exception as e:
-    ai_working = False
-    print(f"Gemini API initialization error: {str(e)}")
-    print("The /tlme command will be disabled due to Gemini API issues")
+# Set up Gemini. The model is created on first use and its health is checked in the background once the
+# client has logged in, so startup doesn't wait on Gemini and AI features recover without a restart.
+ai_working = bool(GEMINI_API_KEY)
+
+# Metrics in the Prometheus text format, served on METRICS_PORT and/or written to METRICS_DUMP_PATH
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_BUCKETS = (50, 100, 250, 500, 1000, 2000, 4000, 8000)
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(labelnames, values, extra=""):
+    pairs = [f'{name}="{escape_label_value(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+# Count of events, split by label values; safe to update from worker threads
+class Counter:
+    kind = "counter"
+    
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}
+        self.lock = threading.Lock()
+    
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+    
+    def samples(self):
+        with self.lock:
+            return [(self.name, format_labels(self.labelnames, labels), value) for labels, value in self.values.items()]
+
+# Distribution of observed values (usually seconds) in cumulative buckets
+class Histogram:
+    kind = "histogram"
+    
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.series = {}  # labels -> [count per bucket..., count above the last bucket, sum]
+        self.lock = threading.Lock()
+    
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+    
+    # Time the block and observe its duration
+    @contextlib.contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+    
+    def samples(self):
+        samples = []
+        with self.lock:
+            for labels, series in self.series.items():
+                total = 0
+                for bound, count in zip(self.buckets, series):
+                    total += count
+                    samples.append((f"{self.name}_bucket", format_labels(self.labelnames, labels, f'le="{bound}"'), total))
+                total += series[-2]
+                samples.append((f"{self.name}_bucket", format_labels(self.labelnames, labels, 'le="+Inf"'), total))
+                samples.append((f"{self.name}_sum", format_labels(self.labelnames, labels), series[-1]))
+                samples.append((f"{self.name}_count", format_labels(self.labelnames, labels), total))
+        return samples
+
+# Values read from the bot's own state when metrics are rendered, e.g. cache hit counters
+class Collected:
+    def __init__(self, name, documentation, labelnames, collect, kind="gauge"):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.collect = collect
+        self.kind = kind
+    
+    # `collect` returns (label values, value) pairs
+    def samples(self):
+        return [(self.name, format_labels(self.labelnames, labels), value) for labels, value in self.collect()]
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+    
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+    
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+    
+    def collected(self, name, documentation, labelnames, collect, kind="gauge"):
+        return self.register(Collected(name, documentation, labelnames, collect, kind))
+    
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+    
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                metrics_log.error("Error collecting metric %s: %s", metric.name, e)
+                continue
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(f"{name}{labels} {value}" for name, labels, value in samples)
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+command_latency = metrics.histogram(
+    "bot_command_duration_seconds", "Time from a slash command being invoked to its handler finishing", ("command", "status")
+)
+chat_messages = metrics.counter("bot_chat_messages_total", "Chat messages received, by route", ("route",))
+chat_reply_latency = metrics.histogram(
+    "bot_chat_reply_duration_seconds", "Time to answer a batch of chat messages", ("route", "status")
+)
+gemini_latency = metrics.histogram("gemini_request_duration_seconds", "Gemini request time", ("mode", "status"))
+gemini_first_chunk_latency = metrics.histogram("gemini_first_chunk_seconds", "Time until the first streamed Gemini chunk")
+gemini_prompt_tokens = metrics.histogram(
+    "gemini_prompt_tokens", "Estimated tokens per Gemini prompt", ("mode",), buckets=TOKEN_BUCKETS
+)
+history_load_latency = metrics.histogram("bot_history_load_seconds", "Time to load a user's chat history", ("source",))
+log_write_latency = metrics.histogram("bot_log_write_seconds", "Time to write a batch of chat log rows to the database")
+log_rows_written = metrics.counter("bot_log_rows_written_total", "Chat log rows written to the database")
+http_latency = metrics.histogram(
+    "http_client_request_duration_seconds", "Outbound HTTP request time", ("host", "method", "status")
+)
+shard_messages = metrics.counter("discord_shard_messages_total", "Messages received, by gateway shard (DMs count as shard 0)", ("shard",))
+shard_events = metrics.counter("discord_shard_events_total", "Gateway shard ready, disconnect and resume events", ("shard", "event"))
+event_loop_lag = metrics.histogram("event_loop_lag_seconds", "How late the event loop ran a timer scheduled by the lag monitor")
+
+# Record outbound requests made through the shared aiohttp session
+def http_trace_config():
+    async def on_request_start(session, context, params):
+        context.started = time.perf_counter()
+    
+    async def on_request_end(session, context, params):
+        http_latency.observe(time.perf_counter() - context.started, params.url.host, params.method, params.response.status)
+    
+    async def on_request_exception(session, context, params):
+        http_latency.observe(time.perf_counter() - context.started, params.url.host, params.method, type(params.exception).__name__)
+    
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+    return trace_config
+
+event_loop_stalls = metrics.counter(
+    "event_loop_stalls_total", "Times the event loop was blocked past WATCHDOG_THRESHOLD, by the task that was running", ("task",)
+)
+
+def name_current_task(name):
+    task = asyncio.current_task()
+    if task is not None:
+        task.set_name(name)
+
+# Where a captured stack was blocking: the innermost frame in bot.py, or the innermost frame if none is
+def blocking_location(stack):
+    for frame in reversed(stack):
+        if os.path.basename(frame.filename) == os.path.basename(__file__):
+            return f"{os.path.basename(frame.filename)}:{frame.lineno} in {frame.name}"
+    frame = stack[-1]
+    return f"{frame.filename}:{frame.lineno} in {frame.name}"
+
+# Samples event loop lag with a heartbeat task. A watchdog thread notices when the heartbeat is more than
+# WATCHDOG_THRESHOLD late, captures the event loop thread's stack while it is still blocked, and attributes
+# the stall to the running task (named after its command or chat route). Top offenders are reported every
+# WATCHDOG_REPORT_INTERVAL seconds.
+class EventLoopWatchdog:
+    def __init__(self, interval, threshold, report_interval, top=5):
+        self.interval = interval
+        self.threshold = threshold
+        self.report_interval = report_interval
+        self.top = top
+        self.loop = None
+        self.loop_thread_id = None
+        self.last_beat = 0
+        self.capture = None  # (task name, location, stack) of the stall in progress
+        self.offenders = {}  # (task name, location) -> [stalls, total lag, worst lag, stack of the worst]
+        self.reported_stalls = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.task = None
+        self.thread = None
+    
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self.task = asyncio.create_task(self.heartbeat(), name="watchdog-heartbeat")
+        if self.threshold > 0:
+            self.thread = threading.Thread(target=self.watch, name="event-loop-watchdog", daemon=True)
+            self.thread.start()
+    
+    async def heartbeat(self):
+        last_report = time.monotonic()
+        while True:
+            expected = self.loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0, self.loop.time() - expected)
+            self.last_beat = time.monotonic()
+            event_loop_lag.observe(lag)
+            
+            with self.lock:
+                capture, self.capture = self.capture, None
+            if capture is not None:
+                self.record(capture, lag)
+            
+            if self.report_interval > 0 and self.last_beat - last_report >= self.report_interval:
+                last_report = self.last_beat
+                self.report()
+    
+    # Runs on the watchdog thread
+    def watch(self):
+        while not self.stopped.wait(self.threshold / 2):
+            late = time.monotonic() - self.last_beat - self.interval
+            if late < self.threshold or self.capture is not None:
+                continue
+            
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)
+            del frame
+            task = asyncio.current_task(self.loop)
+            name = task.get_name() if task is not None else "(loop callback)"
+            with self.lock:
+                self.capture = (name, blocking_location(stack), stack)
+    
+    def record(self, capture, lag):
+        name, location, stack = capture
+        offender = self.offenders.get((name, location))
+        first_time = offender is None
+        if first_time:
+            offender = self.offenders[(name, location)] = [0, 0.0, 0.0, stack]
+        offender[0] += 1
+        offender[1] += lag
+        if lag > offender[2]:
+            offender[2] = lag
+            offender[3] = stack
+        event_loop_stalls.inc(name)
+        
+        # The full stack only the first time, to keep repeat offenders readable
+        fields = {"lag": round(lag, 3), "task": name, "location": location}
+        if first_time:
+            fields["stack"] = "".join(traceback.format_list(stack[-8:]))
+        watchdog_log.warning("Event loop blocked for %.2fs by %s at %s", lag, name, location, extra=fields)
+    
+    # Print the worst offenders, if there were new stalls since the last report
+    def report(self):
+        stalls = sum(offender[0] for offender in self.offenders.values())
+        if stalls == self.reported_stalls:
+            return
+        self.reported_stalls = stalls
+        ranked = sorted(self.offenders.items(), key=lambda item: item[1][1], reverse=True)[:self.top]
+        watchdog_log.info(
+            "Top event loop blockers since startup",
+            extra={"offenders": [
+                {"task": name, "location": location, "stalls": stalls, "total": round(total, 3), "worst": round(worst, 3)}
+                for (name, location), (stalls, total, worst, _) in ranked
+            ]}
+        )
+    
+    def stop(self):
+        self.stopped.set()
+        if self.task is not None:
+            self.task.cancel()
+
+watchdog = EventLoopWatchdog(EVENT_LOOP_LAG_INTERVAL, WATCHDOG_THRESHOLD, WATCHDOG_REPORT_INTERVAL)
+
+# Raised instead of calling a backend whose circuit breaker is open; the message is shown to the user
+class BackendUnavailable(Exception):
+    def __init__(self, breaker):
+        self.breaker = breaker
+        self.retry_after = breaker.retry_after()
+        super().__init__(
+            f"The {breaker.label} service is having problems right now. Please try again in {max(1, round(self.retry_after))} seconds."
+        )
+
+# Outcome of one guarded call; call fail() for responses that arrived but count as errors (e.g. HTTP 5xx),
+# and mark_latency() to measure latency at that point instead of at the end (e.g. first streamed chunk)
+class BreakerCall:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.ok = True
+        self.latency = None
+    
+    def fail(self):
+        self.ok = False
+    
+    def mark_latency(self):
+        if self.latency is None:
+            self.latency = time.monotonic() - self.started
+
+# Circuit breaker for one external backend. It opens after BREAKER_FAILURE_THRESHOLD failures in a row or
+# when BREAKER_ERROR_RATE of the last BREAKER_WINDOW calls failed; calls slower than `slow_call_seconds`
+# count as failures. While open, calls fail fast with BackendUnavailable. After BREAKER_RESET_TIMEOUT one
+# probe call is let through (half-open): success closes the breaker, failure opens it again.
+class CircuitBreaker:
+    def __init__(self, name, label, slow_call_seconds):
+        self.name = name
+        self.label = label
+        self.slow_call_seconds = slow_call_seconds
+        self.state = "closed"
+        self.outcomes = deque(maxlen=BREAKER_WINDOW)  # True for each successful call
+        self.consecutive_failures = 0
+        self.opened_at = 0
+        self.probing = False
+        self.average_latency = None
+        self.calls = 0
+        self.failures = 0
+        self.rejected = 0
+        self.opened = 0
+    
+    def retry_after(self):
+        if self.state != "open":
+            return 0
+        return max(0, self.opened_at + BREAKER_RESET_TIMEOUT - time.monotonic())
+    
+    # Whether a call would be let through right now
+    def available(self):
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            return self.retry_after() <= 0
+        return not self.probing
+    
+    # Fail fast before queueing for a backend that wouldn't be called anyway
+    def check(self):
+        if not self.available():
+            self.rejected += 1
+            raise BackendUnavailable(self)
+    
+    def error_rate(self):
+        if not self.outcomes:
+            return 0
+        return self.outcomes.count(False) / len(self.outcomes)
+    
+    def _before_call(self):
+        if self.state == "open" and self.retry_after() <= 0:
+            self.state = "half-open"
+            breaker_log.info("Circuit breaker for %s is half-open, sending a probe request", self.name)
+        if self.state == "half-open":
+            if self.probing:
+                self.rejected += 1
+                raise BackendUnavailable(self)
+            self.probing = True
+        elif self.state == "open":
+            self.rejected += 1
+            raise BackendUnavailable(self)
+    
+    def _record(self, ok, latency):
+        self.calls += 1
+        self.average_latency = latency if self.average_latency is None else 0.8 * self.average_latency + 0.2 * latency
+        if ok and self.slow_call_seconds and latency > self.slow_call_seconds:
+            ok = False
+        
+        self.outcomes.append(ok)
+        if ok:
+            self.consecutive_failures = 0
+        else:
+            self.failures += 1
+            self.consecutive_failures += 1
+        
+        if self.state == "half-open":
+            self.probing = False
+            if ok:
+                self.state = "closed"
+                self.outcomes.clear()
+                breaker_log.info("Circuit breaker for %s closed, the service has recovered", self.name)
+            else:
+                self._open()
+        elif self.state == "closed" and not ok:
+            too_many_errors = len(self.outcomes) >= BREAKER_MIN_CALLS and self.error_rate() >= BREAKER_ERROR_RATE
+            if self.consecutive_failures >= BREAKER_FAILURE_THRESHOLD or too_many_errors:
+                self._open()
+    
+    def _open(self):
+        self.state = "open"
+        self.opened_at = time.monotonic()
+        self.opened += 1
+        breaker_log.warning(
+            "Circuit breaker for %s opened after %d failures in a row (%.0f%% of recent calls failed); failing fast for %.0f seconds",
+            self.name, self.consecutive_failures, self.error_rate() * 100, BREAKER_RESET_TIMEOUT
+        )
+    
+    # Wrap one call to the backend: raises BackendUnavailable while open and records how the call went
+    @contextlib.contextmanager
+    def guard(self):
+        self._before_call()
+        call = BreakerCall()
+        try:
+            yield call
+        except (asyncio.CancelledError, GeneratorExit):
+            # The caller gave up; that says nothing about the backend
+            if self.state == "half-open":
+                self.probing = False
+            raise
+        except Exception:
+            self._record(False, time.monotonic() - call.started)
+            raise
+        else:
+            call.mark_latency()
+            self._record(call.ok, call.latency)
+    
+    # Short description of the breaker's state for /help
+    def describe(self):
+        if self.state == "open":
+            return f"🔴 Unavailable (retrying in {max(1, round(self.retry_after()))}s)"
+        if self.state == "half-open":
+            return "🟡 Recovering"
+        if self.average_latency is None:
+            return "🟢 OK"
+        return f"🟢 OK ({self.average_latency:.1f}s avg)"
+    
+    def snapshot(self):
+        return {
+            "state": self.state,
+            "error_rate": self.error_rate(),
+            "average_latency": self.average_latency,
+            "calls": self.calls,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "opened": self.opened,
+        }
+
+# One breaker per external service; calls slower than half the service's timeout count as failures
+circuit_breakers = {
+    breaker.name: breaker for breaker in [
+        CircuitBreaker("gemini", "AI", GEMINI_TIMEOUT / 2),
+        CircuitBreaker("huggingface", "image generation", IMGEN_TIMEOUT / 2),
+        CircuitBreaker("openweathermap", "weather", WEATHER_TIMEOUT / 2),
+        CircuitBreaker("meme-api", "meme", HTTP_TIMEOUT / 2),
+        CircuitBreaker("thecatapi", "cat picture", HTTP_TIMEOUT / 2),
+        CircuitBreaker("thedogapi", "dog picture", HTTP_TIMEOUT / 2),
+    ]
+}
+
+# Runs Gemini completions on a bounded thread pool so a slow reply never blocks the event loop
+class GenerationEngine:
+    def __init__(self, api_key, model_name, max_concurrency, timeout, breaker):
+        self.api_key = api_key
+        self.model_name = model_name
+        self.breaker = breaker
+        self.model = None
+        self.max_concurrency = max(1, max_concurrency)
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="gemini")
+        # Health checks get their own worker so a busy or stuck generation pool doesn't fail them
+        self.health_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gemini-health")
+        # Created on first use so it binds to the loop started by client.run()
+        self.semaphore = None
+    
+    # Create the model client; this doesn't contact Gemini
+    def load_model(self):
+        if self.model is None:
+            if not self.api_key:
+                raise RuntimeError("Gemini API key is not configured")
+            genai.configure(api_key=self.api_key)
+            self.model = genai.GenerativeModel(self.model_name)
+        return self.model
+    
+    # Run fn on the thread pool in a slot already taken from the semaphore. The slot is given back when the
+    # thread finishes, not when the caller stops waiting, so a call abandoned on timeout keeps its slot and
+    # the next request waits for it before its own timeout starts
+    def _submit(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        
+        def release(_):
+            try:
+                loop.call_soon_threadsafe(self.semaphore.release)
+            except RuntimeError:
+                # The event loop has already shut down
+                pass
+        
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(release)
+        return asyncio.wrap_future(future, loop=loop)
+    
+    def _generate_sync(self, prompt):
+        response = self.model.generate_content(prompt)
+        return response.text
+    
+    # Generate a completion for the prompt and return its text
+    async def generate(self, prompt, timeout=None):
+        self.load_model()
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        
+        self.breaker.check()
+        gemini_prompt_tokens.observe(estimate_tokens(prompt), "generate")
+        await self.semaphore.acquire()
+        started = time.perf_counter()
+        status = "error"
+        future = None
+        try:
+            with self.breaker.guard():
+                future = self._submit(self._generate_sync, prompt)
+                text = await asyncio.wait_for(future, timeout or self.timeout)
+            status = "ok"
+            return text
+        except asyncio.TimeoutError:
+            status = "timeout"
+            raise
+        finally:
+            if future is None:
+                self.semaphore.release()
+            gemini_latency.observe(time.perf_counter() - started, "generate", status)
+    
+    # Runs on the thread pool, passing streamed chunks back to the event loop through the queue
+    def _stream_sync(self, prompt, loop, queue, stop):
+        def put(item):
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+            except RuntimeError:
+                # The event loop has already shut down
+                stop.set()
+        
+        try:
+            for chunk in self.model.generate_content(prompt, stream=True):
+                if stop.is_set():
+                    return
+                text = chunk.text
+                if text:
+                    put(("text", text))
+        except Exception as e:
+            put(("error", e))
+        else:
+            put(("done", None))
+    
+    # Generate a completion and yield its text as it arrives; `timeout` is the longest wait for each chunk.
+    # Callers that stop early should aclose() the generator so the worker stops at the next chunk and frees its slot.
+    async def stream(self, prompt, timeout=None):
+        self.load_model()
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        
+        self.breaker.check()
+        gemini_prompt_tokens.observe(estimate_tokens(prompt), "stream")
+        await self.semaphore.acquire()
+        started = time.perf_counter()
+        status = "error"
+        future = None
+        try:
+            with self.breaker.guard() as call:
+                loop = asyncio.get_running_loop()
+                queue = asyncio.Queue()
+                stop = threading.Event()
+                future = self._submit(self._stream_sync, prompt, loop, queue, stop)
+                try:
+                    while True:
+                        kind, value = await asyncio.wait_for(queue.get(), timeout or self.timeout)
+                        # Judge streamed replies by how long the first chunk took
+                        if call.latency is None:
+                            call.mark_latency()
+                            gemini_first_chunk_latency.observe(call.latency)
+                        if kind == "text":
+                            yield value
+                        elif kind == "error":
+                            raise value
+                        else:
+                            status = "ok"
+                            return
+                finally:
+                    stop.set()
+        except asyncio.TimeoutError:
+            status = "timeout"
+            raise
+        except (GeneratorExit, asyncio.CancelledError):
+            status = "cancelled"
+            raise
+        finally:
+            if future is None:
+                self.semaphore.release()
+            gemini_latency.observe(time.perf_counter() - started, "stream", status)
+    
+    # Check that the key and model work by counting tokens, which doesn't generate anything
+    async def check_health(self, timeout=None):
+        try:
+            model = self.load_model()
+            loop = asyncio.get_running_loop()
+            await asyncio.wait_for(
+                loop.run_in_executor(self.health_executor, model.count_tokens, "Hello"),
+                timeout or self.timeout
+            )
+            return True, None
+        except asyncio.TimeoutError:
+            return False, f"no response after {timeout or self.timeout} seconds"
+        except Exception as e:
+            return False, str(e)
+    
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+        self.health_executor.shutdown(wait=False)
+
+gemini_engine = GenerationEngine(
+    GEMINI_API_KEY, 'gemini-2.0-flash', GEMINI_MAX_CONCURRENCY, GEMINI_TIMEOUT, circuit_breakers["gemini"]
+)
+
+# Token bucket holding up to `capacity` requests, refilled continuously at `rate` per minute
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate / 60
+        self.capacity = max(1, capacity)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+    
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    # Seconds until a whole token is available
+    def retry_after(self):
+        if self.tokens >= 1:
+            return 0
+        if self.rate <= 0:
+            return float("inf")
+        return (1 - self.tokens) / self.rate
+
+# Per-user, per-guild and global limits on AI requests; a request over any limit is rejected straight away
+class AdmissionController:
+    def __init__(self):
+        self.global_bucket = TokenBucket(AI_GLOBAL_RATE, AI_GLOBAL_BURST)
+        self.user_buckets = {}
+        self.guild_buckets = {}
+        self.admitted = 0
+        self.rejected = {"user": 0, "guild": 0, "global": 0}
+    
+    # Returns (None, 0) when the request may go ahead, otherwise (limit scope, seconds to wait)
+    def admit(self, user_id, guild_id=None):
+        now = time.monotonic()
+        scopes = [("user", self._bucket(self.user_buckets, user_id, AI_USER_RATE, AI_USER_BURST, now))]
+        if guild_id is not None:
+            scopes.append(("guild", self._bucket(self.guild_buckets, guild_id, AI_GUILD_RATE, AI_GUILD_BURST, now)))
+        self.global_bucket.refill(now)
+        scopes.append(("global", self.global_bucket))
+        
+        # Only take tokens once every limit allows the request
+        for scope, bucket in scopes:
+            if bucket.tokens < 1:
+                self.rejected[scope] += 1
+                return scope, bucket.retry_after()
+        for _, bucket in scopes:
+            bucket.tokens -= 1
+        self.admitted += 1
+        return None, 0
+    
+    def _bucket(self, buckets, key, rate, capacity, now):
+        bucket = buckets.get(key)
+        if bucket is None:
+            if len(buckets) >= 10000:
+                self._prune(buckets, now)
+            bucket = buckets[key] = TokenBucket(rate, capacity)
+        bucket.refill(now)
+        return bucket
+    
+    # Forget buckets that have refilled completely; they behave exactly like new ones
+    def _prune(self, buckets, now):
+        for key in list(buckets):
+            bucket = buckets[key]
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity:
+                del buckets[key]
+    
+    # Current usage for monitoring
+    def snapshot(self):
+        self.global_bucket.refill(time.monotonic())
+        return {
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+            "global_tokens": round(self.global_bucket.tokens, 2),
+            "global_capacity": self.global_bucket.capacity,
+            "tracked_users": len(self.user_buckets),
+            "tracked_guilds": len(self.guild_buckets),
+        }
+
+admission = AdmissionController()
+
+# Friendly replies for requests over each limit
+def admission_rejection_message(scope, retry_after):
+    wait = f"{max(1, round(retry_after))} seconds" if retry_after != float("inf") else "a bit"
+    if scope == "user":
+        return f"Whoa, slow down a little! 😅 Give me {wait} and try again."
+    if scope == "guild":
+        return f"I'm chatting with a lot of people in this server right now. Try again in {wait}?"
+    return f"I'm super busy right now! Try again in {wait}?"
+
+# Set up intents
+intents = discord.Intents.default()
+intents.message_content = True
+
+# Patterns that indicate someone is asking about the creator/owner
+default_creator_patterns = [
+    "who created you", 
+    "who made you", 
+    "who developed you",
+    "who is your owner", 
+    "who is your creator",
+    "who owns you",
+    "who built you",
+    "who programmed you",
+    "your creator",
+    "your developer",
+    "your owner",
+    "who wrote you",
+    "who designed you"
+]
+
+# Patterns for Airi channel names
+default_airi_patterns = [
+    "airi",
+    "ai-ri",
+    "chat-with-airi",
+    "airi-chatting"
+]
+
+# Read a comma-separated pattern list from the environment, falling back to the defaults
+def load_patterns(env_name, defaults):
+    value = os.getenv(env_name)
+    if not value:
+        return defaults
+    return [pattern.strip() for pattern in value.split(",") if pattern.strip()]
+
+# Build a regex from a character trie of the patterns, so shared prefixes like "who " are only checked once
+def build_trie_regex(patterns):
+    trie = {}
+    for pattern in patterns:
+        node = trie
+        for char in pattern.lower():
+            node = node.setdefault(char, {})
+        node[""] = {}
+    
+    def render(node):
+        if "" in node and len(node) == 1:
+            return ""
+        branches = []
+        optional = False
+        for char in sorted(node):
+            if char == "":
+                optional = True
+            else:
+                branches.append(re.escape(char) + render(node[char]))
+        # A pattern ending here means the rest is optional; the shortest match is enough for a yes/no check
+        if optional:
+            return ""
+        if len(branches) == 1:
+            return branches[0]
+        return "(?:" + "|".join(branches) + ")"
+    
+    if not trie:
+        # No patterns configured: never match
+        return re.compile(r"(?!)")
+    return re.compile(render(trie), re.IGNORECASE)
+
+creator_matcher = build_trie_regex(load_patterns('CREATOR_PATTERNS', default_creator_patterns))
+airi_channel_matcher = build_trie_regex(load_patterns('AIRI_CHANNEL_PATTERNS', default_airi_patterns))
+
+# Function to check if a message is asking about the bot's creator
+def is_asking_about_creator(message_content):
+    return creator_matcher.search(message_content) is not None
+
+# Channel id -> (channel name, is Airi channel), so each channel is only classified once per name
+airi_channel_cache = {}
+
+# Function to check if channel name contains Airi variations
+def is_airi_channel(channel):
+    name = getattr(channel, "name", None)
+    if not name:
+        return False
+    
+    cached = airi_channel_cache.get(channel.id)
+    if cached is not None and cached[0] == name:
+        return cached[1]
+    
+    if len(airi_channel_cache) >= 100000:
+        airi_channel_cache.clear()
+    result = airi_channel_matcher.search(name) is not None
+    airi_channel_cache[channel.id] = (name, result)
+    return result
+
+# Matches the start of each entry written by append_to_conversation_log
+log_entry_pattern = re.compile(r'^\[(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})\] \[(.*?)\] (USER|BOT): ', re.MULTILINE)
+
+# Render a stored message in the conversation log format used in prompts
+def format_log_entry(timestamp, location, sender, message):
+    return f"[{timestamp}] [{location}] {sender}: {message}\n\n"
+
+# Rough token estimate (Gemini averages about 4 characters per token for English text)
+def estimate_tokens(text):
+    return (len(text) + 3) // 4
+
+# Split a conversation log into individual entries, oldest first
+def split_log_entries(history):
+    starts = [match.start() for match in log_entry_pattern.finditer(history)]
+    if not starts:
+        return [history] if history.strip() else []
+    
+    entries = []
+    for index, start in enumerate(starts):
+        end = starts[index + 1] if index + 1 < len(starts) else len(history)
+        entries.append(history[start:end])
+    return entries
+
+# Cut a log entry down to about `token_budget` tokens, keeping its header and the end of the message
+def truncate_log_entry(entry, token_budget):
+    if estimate_tokens(entry) <= token_budget:
+        return entry
+    match = log_entry_pattern.match(entry)
+    header = entry[:match.end()] if match else ""
+    keep = max(0, token_budget * 4 - len(header) - 3)
+    return header + "..." + (entry[len(entry) - keep:] if keep else "")
+
+# Short extractive summary of the turns that did not fit in the context budget
+def summarize_dropped_turns(entries, token_budget):
+    char_budget = token_budget * 4
+    header = f"(Summary of {len(entries)} older messages) Earlier, the user talked about: "
+    snippets = []
+    # Includes the blank line that ends the summary
+    used = len(header) + 2
+    
+    # Walk backwards so the most recent of the dropped topics are kept
+    for entry in reversed(entries):
+        match = log_entry_pattern.match(entry)
+        if not match or match.group(3) != "USER":
+            continue
+        text = " ".join(entry[match.end():].split())
+        if len(text) > 80:
+            text = text[:77] + "..."
+        if used + len(text) + 2 > char_budget:
+            break
+        snippets.append(text)
+        used += len(text) + 2
+    
+    if not snippets:
+        return ""
+    return header + "; ".join(reversed(snippets)) + "\n\n"
+
+# The history actually sent to the model, with figures on how much of it was used
+class ConversationContext:
+    def __init__(self, text="", turns_included=0, turns_total=0, summarized_turns=0):
+        self.text = text
+        self.turns_included = turns_included
+        self.turns_total = turns_total
+        self.summarized_turns = summarized_turns
+        self.tokens = estimate_tokens(text)
+    
+    def __str__(self):
+        return f"{self.turns_included}/{self.turns_total} turns, ~{self.tokens} tokens" + (
+            f", {self.summarized_turns} summarized" if self.summarized_turns else ""
+        )
+
+# LRU cache holding the most recent log entries of active users, so replies don't re-read their log file
+class ConversationCache:
+    def __init__(self, max_chars, user_chars, idle_seconds):
+        self.max_chars = max_chars
+        self.user_chars = user_chars
+        self.idle_seconds = idle_seconds
+        self.users = OrderedDict()  # user_id -> [entries, size, last_used, stored rows]
+        self.loading = {}  # user_id -> [loads in flight, entries appended since the first began]
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, user_id):
+        item = self.users.get(user_id)
+        if item is None:
+            self.misses += 1
+            return None
+        
+        if time.monotonic() - item[2] > self.idle_seconds:
+            self._remove(user_id)
+            self.misses += 1
+            return None
+        
+        item[2] = time.monotonic()
+        self.users.move_to_end(user_id)
+        self.hits += 1
+        return "".join(item[0])
+    
+    # Call before reading the user's history from the store, and finish_load() once done. Entries appended
+    # meanwhile may have missed the read, so put() adds back any the loaded history doesn't already end with
+    def start_load(self, user_id):
+        self.loading.setdefault(user_id, [0, []])[0] += 1
+    
+    def finish_load(self, user_id):
+        loading = self.loading.get(user_id)
+        if loading is not None:
+            loading[0] -= 1
+            if loading[0] <= 0:
+                del self.loading[user_id]
+    
+    # `stored_rows` is how many messages the store held for the user when `history` was read, if known
+    def put(self, user_id, history, stored_rows=None):
+        self._remove(user_id)
+        entries = split_log_entries(history)
+        loading = self.loading.get(user_id)
+        if loading is not None:
+            recent = entries[-len(loading[1]):] if loading[1] else []
+            missed = [entry for entry in loading[1] if entry not in recent]
+            entries.extend(missed)
+            if stored_rows is not None:
+                stored_rows += len(missed)
+        item = [entries, sum(len(entry) for entry in entries), time.monotonic(), stored_rows]
+        self.users[user_id] = item
+        self.size += item[1]
+        self._trim(item)
+        self._evict()
+        return "".join(item[0])
+    
+    # Write-through for a new log entry; users that aren't cached are left to be loaded on demand
+    def append(self, user_id, entry):
+        loading = self.loading.get(user_id)
+        if loading is not None:
+            loading[1].append(entry)
+        
+        item = self.users.get(user_id)
+        if item is None:
+            return
+        
+        item[0].append(entry)
+        item[1] += len(entry)
+        item[2] = time.monotonic()
+        if item[3] is not None:
+            item[3] += 1
+        self.size += len(entry)
+        self.users.move_to_end(user_id)
+        self._trim(item)
+        self._evict()
+    
+    # Messages the store should hold for the user if nothing but this process wrote to it
+    def stored_rows(self, user_id):
+        item = self.users.get(user_id)
+        return item[3] if item is not None else None
+    
+    # Keep only the newest entries that fit in the per-user limit
+    def _trim(self, item):
+        entries = item[0]
+        while len(entries) > 1 and item[1] > self.user_chars:
+            removed = len(entries.pop(0))
+            item[1] -= removed
+            self.size -= removed
+    
+    def _evict(self):
+        now = time.monotonic()
+        # Idle users sit at the front of the LRU order, so expire those first
+        while self.users:
+            user_id, item = next(iter(self.users.items()))
+            if self.size <= self.max_chars and now - item[2] <= self.idle_seconds:
+                break
+            self._remove(user_id)
+    
+    def _remove(self, user_id):
+        item = self.users.pop(user_id, None)
+        if item is not None:
+            self.size -= item[1]
+
+# SQLite (WAL) store for conversation logs, indexed by user and timestamp
+class ConversationStore:
+    def __init__(self, path):
+        self.path = path
+        # Opened in setup_hook, so importing bot.py doesn't create the database
+        self.conn = None
+    
+    def open(self):
+        if self.conn is not None:
+            return
+        # Only used from the log writer's database thread once the bot is running
+        # Sharded bot processes may share the database, so wait for each other's writes instead of failing
+        self.conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                timestamp TEXT NOT NULL,
+                location TEXT NOT NULL,
+                sender TEXT NOT NULL,
+                message TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_messages_user_time ON messages (user_id, timestamp, id);
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+        """)
+    
+    def append(self, user_id, timestamp, location, sender, message):
+        self.append_many([(user_id, timestamp, location, sender, message)])
+    
+    # Insert (user_id, timestamp, location, sender, message) rows in a single transaction
+    def append_many(self, rows):
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self._insert(rows)
+    
+    def _insert(self, rows):
+        self.conn.executemany(
+            "INSERT INTO messages (user_id, timestamp, location, sender, message) VALUES (?, ?, ?, ?, ?)",
+            rows
+        )
+    
+    # The user's last `limit` messages, oldest first
+    def last_turns(self, user_id, limit):
+        rows = self.conn.execute(
+            "SELECT timestamp, location, sender, message FROM messages "
+            "WHERE user_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?",
+            (user_id, limit)
+        ).fetchall()
+        rows.reverse()
+        return rows
+    
+    # How many messages are stored for the user; used to tell whether another process added some
+    def count_turns(self, user_id):
+        return self.conn.execute("SELECT COUNT(*) FROM messages WHERE user_id = ?", (user_id,)).fetchone()[0]
+    
+    # The user's messages with start <= timestamp < end, oldest first (timestamps as "YYYY-MM-DD HH:MM:SS")
+    def turns_between(self, user_id, start, end):
+        return self.conn.execute(
+            "SELECT timestamp, location, sender, message FROM messages "
+            "WHERE user_id = ? AND timestamp >= ? AND timestamp < ? ORDER BY timestamp, id",
+            (user_id, start, end)
+        ).fetchall()
+    
+    def get_meta(self, key):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+    
+    def set_meta(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+    
+    # One-shot import of the old logs/users/<user_id>.txt files. It runs in a single transaction with the
+    # "imported" marker, so an interrupted import leaves nothing behind and is simply redone on the next start.
+    # BEGIN IMMEDIATE takes the write lock before checking the marker, so processes sharing the database import once.
+    def import_text_logs(self, users_dir):
+        imported = 0
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            if self.get_meta("text_logs_imported"):
+                return 0
+            
+            for log_file in sorted(pathlib.Path(users_dir).glob("*.txt")):
+                if not log_file.stem.isdigit():
+                    continue
+                try:
+                    content = log_file.read_text(encoding='utf-8')
+                except Exception as e:
+                    store_log.error("Error reading %s during import: %s", log_file, e)
+                    continue
+                
+                rows = []
+                for entry in split_log_entries(content):
+                    match = log_entry_pattern.match(entry)
+                    if not match:
+                        continue
+                    message = entry[match.end():]
+                    if message.endswith("\n\n"):
+                        message = message[:-2]
+                    rows.append((int(log_file.stem), match.group(1), match.group(2), match.group(3), message))
+                
+                if rows:
+                    self._insert(rows)
+                    imported += len(rows)
+            
+            self.set_meta("text_logs_imported", datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        if imported:
+            store_log.info("Imported %d messages from text logs into %s", imported, self.path)
+        return imported
+    
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+conversation_store = ConversationStore(CONVERSATION_DB_PATH)
+
+# Queues conversation log rows in memory and writes them to the store in batches from a background task.
+# All database work runs on one dedicated thread, so reads always see earlier writes and never block the event loop.
+class ConversationLogWriter:
+    def __init__(self, store, batch_size, flush_interval, max_pending=10000):
+        self.store = store
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="log-writer")
+        self.pending = []
+        self.task = None
+        self.wakeup = None
+        self.flush_lock = None
+    
+    def start(self):
+        if self.task is None:
+            self.wakeup = asyncio.Event()
+            self.flush_lock = asyncio.Lock()
+            self.task = asyncio.create_task(self.run(), name="log-writer")
+    
+    # Queue a (user_id, timestamp, location, sender, message) row
+    def write(self, row):
+        self.pending.append(row)
+        if len(self.pending) > self.max_pending:
+            dropped = len(self.pending) - self.max_pending
+            del self.pending[:dropped]
+            store_log.warning("Conversation log writer is backed up, dropped %d oldest messages", dropped)
+        if len(self.pending) >= self.batch_size and self.wakeup is not None:
+            self.wakeup.set()
+    
+    def has_pending(self, user_id):
+        return any(row[0] == user_id for row in self.pending)
+    
+    # Run a store call on the database thread
+    async def run_db(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+    
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+    
+    async def flush(self):
+        if self.flush_lock is None:
+            self.flush_lock = asyncio.Lock()
+        # Shielded so a cancelled caller, such as a chat reply replaced by a newer message, can't drop queued rows
+        await asyncio.shield(self._flush())
+    
+    async def _flush(self):
+        async with self.flush_lock:
+            if not self.pending:
+                return
+            rows, self.pending = self.pending, []
+            try:
+                with log_write_latency.time():
+                    await self.run_db(self.store.append_many, rows)
+                log_rows_written.inc(amount=len(rows))
+            except Exception as e:
+                store_log.error("Error writing conversation logs: %s", e)
+                # Keep the rows so the next flush retries them
+                self.pending = rows + self.pending
+    
+    # Stop the background task and write everything still queued
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.flush()
+        self.executor.shutdown(wait=True)
+
+log_writer = ConversationLogWriter(conversation_store, LOG_WRITER_BATCH_SIZE, LOG_WRITER_FLUSH_INTERVAL)
+
+conversation_cache = ConversationCache(
+    CONVERSATION_CACHE_MAX_CHARS,
+    CONVERSATION_CACHE_USER_CHARS,
+    CONVERSATION_CACHE_IDLE_SECONDS
+)
+
+# Log-style content the model sometimes echoes back from the conversation history
+log_timestamp_pattern = re.compile(r'\[\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}\]')
+# A "[timestamp]" or "[...] USER:" / "[...] BOT:" log line
+log_line_pattern = re.compile(r'\[(?:(?P<timestamp>\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}\])|.*\] (?:USER|BOT):)')
+# Phrases that show a line is talking about the chat history
+history_marker_matcher = build_trie_regex([
+    "conversation history", 
+    "chat history",
+    "previous messages",
+    "our conversation",
+    "earlier conversation",
+    "from our previous"
+])
+
+fallback_reply = "I understand your message, but I'm having trouble formulating a proper response. Could you try asking again in a different way?"
+
+# Incremental version of clean_response for streamed replies: feed() text as it arrives, text() for what
+# can be shown so far, and finish() for the final reply (identical to clean_response on the full text)
+class ResponseSanitizer:
+    def __init__(self):
+        self.lines = []
+        self.partial = ""
+        self.cleaned_lines = []
+        self.skip_line = False
+        self.last_timestamp_line = -1
+    
+    def feed(self, text):
+        self.partial += text
+        if '\n' in text:
+            *complete, self.partial = self.partial.split('\n')
+            for line in complete:
+                self._process(line)
+    
+    # Skip log-formatted lines and history markers, plus the lines that follow them up to the next blank line
+    def _process(self, line):
+        index = len(self.lines)
+        self.lines.append(line)
+        
+        match = log_line_pattern.search(line)
+        if match:
+            if match.group('timestamp') or log_timestamp_pattern.search(line, match.start() + 1):
+                self.last_timestamp_line = index
+            self.skip_line = True
+            return
+        
+        if history_marker_matcher.search(line):
+            self.skip_line = True
+            return
+        
+        # If we're skipping but encounter an empty line, stop skipping
+        if self.skip_line and not line.strip():
+            self.skip_line = False
+            return
+        
+        if not self.skip_line:
+            self.cleaned_lines.append(line)
+    
+    # Best view of the reply so far; the unfinished last line is held back while it could still be a log line
+    def text(self):
+        partial = self.partial
+        if partial.startswith('[') or self.skip_line or log_line_pattern.search(partial) or history_marker_matcher.search(partial):
+            partial = ""
+        
+        if self.last_timestamp_line < 0:
+            return "\n".join(self.lines + [partial]).strip()
+        return "\n".join(self.cleaned_lines + [partial]).strip()
+    
+    def finish(self):
+        self._process(self.partial)
+        self.partial = ""
+        
+        # Responses are only cleaned when they actually contain log timestamps
+        if self.last_timestamp_line < 0:
+            return "\n".join(self.lines)
+        
+        chat_log.warning("Bot response contained log-like timestamp format. Cleaning response.")
+        
+        cleaned_response = "\n".join(self.cleaned_lines).strip()
+        if not cleaned_response:
+            # If we filtered out too much, use whatever follows the last timestamped line
+            cleaned_response = "\n".join(self.lines[self.last_timestamp_line + 1:]).strip() or fallback_reply
+        
+        return cleaned_response
+
+# Function to filter out log content from responses, in a single pass over the lines
+def clean_response(response_text):
+    # Most replies contain no log timestamps and are returned untouched
+    if not log_timestamp_pattern.search(response_text):
+        return response_text
+    
+    sanitizer = ResponseSanitizer()
+    sanitizer.feed(response_text)
+    return sanitizer.finish()
+
+# Opening "```lang" fences and closing "```" fences in a reply
+code_fence_pattern = re.compile(r'```([\w+#.-]{0,20})')
+
+# Language of the code block left open at the end of `text`, or None when all code blocks are closed
+def open_code_fence(text):
+    language = None
+    for match in code_fence_pattern.finditer(text):
+        language = match.group(1) if language is None else None
+    return language
+
+# Where to cut `text` so the first part fits in `budget`: prefer paragraphs, then lines, sentences and words.
+# Returns (end of the first part, start of the rest).
+def find_split(text, budget):
+    minimum = budget // 2
+    
+    index = text.rfind("\n\n", minimum, budget)
+    if index != -1:
+        return index, index + 2
+    
+    index = text.rfind("\n", minimum, budget)
+    if index != -1:
+        return index, index + 1
+    
+    index = max(text.rfind(". ", minimum, budget), text.rfind("! ", minimum, budget), text.rfind("? ", minimum, budget))
+    if index != -1:
+        return index + 1, index + 2
+    
+    index = text.rfind(" ", minimum, budget)
+    if index != -1:
+        return index, index + 1
+    
+    return budget, budget
+
+# Split a reply into Discord-sized messages on natural boundaries, closing and reopening code blocks across messages
+def split_message(text, limit=2000):
+    chunks = []
+    reopen = ""
+    while text:
+        text = reopen + text
+        if len(text) <= limit:
+            chunks.append(text)
+            break
+        
+        # Leave room to close a code block at the end of the chunk
+        end, rest = find_split(text, limit - 4)
+        chunk = text[:end]
+        text = text[rest:]
+        
+        language = open_code_fence(chunk)
+        if language is not None:
+            chunk += "\n```"
+            reopen = f"```{language}\n"
+        else:
+            reopen = ""
+        chunks.append(chunk)
+    return chunks
+
+# Shows a reply that may be streamed: the first text is sent as a new message, then edited as more arrives
+# (no more often than STREAM_EDIT_INTERVAL), with extra messages for text past `limit`. A final reply longer
+# than LONG_REPLY_ATTACHMENT_CHARS is shown as a preview with the full text attached as a file.
+#   send(text, file=None) -> message  sends the first message
+#   send_more(text) -> message        sends each further message
+#   edit(message, text, file=None)    edits a sent message
+class StreamingReply:
+    def __init__(self, send, edit, send_more=None, before_send=None, limit=2000, interval=None):
+        self.send = send
+        self.edit = edit
+        self.send_more = send_more or send
+        self.before_send = before_send
+        self.limit = limit
+        self.interval = STREAM_EDIT_INTERVAL if interval is None else interval
+        self.messages = []
+        self.shown = []
+        self.last_update = 0
+    
+    async def update(self, text):
+        if not text.strip():
+            return
+        if self.messages and time.monotonic() - self.last_update < self.interval:
+            return
+        # Don't post more messages than a reply that ends up as an attachment would need
+        await self._show(text[:LONG_REPLY_ATTACHMENT_CHARS])
+    
+    # Show the final text, sending it as normal messages if nothing was streamed
+    async def finish(self, text):
+        if len(text) > LONG_REPLY_ATTACHMENT_CHARS:
+            await self._show_attachment(text)
+        else:
+            await self._show(text)
+    
+    async def _show(self, text):
+        chunks = split_message(text, self.limit) or [text]
+        for index, chunk in enumerate(chunks):
+            if index < len(self.messages):
+                if self.shown[index] != chunk:
+                    await self.edit(self.messages[index], chunk)
+                    self.shown[index] = chunk
+            elif index == 0:
+                if self.before_send is not None:
+                    self.before_send()
+                self.messages.append(await self.send(chunk))
+                self.shown.append(chunk)
+            else:
+                self.messages.append(await self.send_more(chunk))
+                self.shown.append(chunk)
+        
+        # The final cleaned reply can be shorter than what was streamed
+        await self._delete_from(len(chunks))
+        self.last_update = time.monotonic()
+    
+    async def _show_attachment(self, text):
+        preview = split_message(text, self.limit - 40)[0] + "\n\n📄 *Full reply attached.*"
+        file = discord.File(io.BytesIO(text.encode('utf-8')), filename="reply.txt")
+        if self.messages:
+            await self.edit(self.messages[0], preview, file=file)
+            self.shown[0] = preview
+            await self._delete_from(1)
+        else:
+            if self.before_send is not None:
+                self.before_send()
+            self.messages.append(await self.send(preview, file=file))
+            self.shown.append(preview)
+    
+    async def _delete_from(self, index):
+        for message in self.messages[index:]:
+            try:
+                await message.delete()
+            except Exception as e:
+                chat_log.error("Error deleting streamed message: %s", e)
+        del self.messages[index:]
+        del self.shown[index:]
+
+# Edit a sent chat message, optionally replacing its attachments with `file`
+async def edit_message(message, text, file=None):
+    if file is not None:
+        return await message.edit(content=text, attachments=[file])
+    return await message.edit(content=text)
 
-# Set up intents
-intents = discord.Intents.default()
-intents.message_content = True
+# Messages starting with these are probably meant for other bots
+command_prefixes = ('/', '!', '?', '-', '>')
 
-# Function to check if a message is asking about the bot's creator
-def is_asking_about_creator(message_content):
-    # Convert to lowercase for case-insensitive matching
-    message = message_content.lower()
-    
-    # Patterns that indicate someone is asking about the creator/owner
-    creator_patterns = [
-        "who created you", 
-        "who made you", 
-        "who developed you",
-        "who is your owner", 
-        "who is your creator",
-        "who owns you",
-        "who built you",
-        "who programmed you",
-        "your creator",
-        "your developer",
-        "your owner",
-        "who wrote you",
-        "who designed you"
-    ]
+# A message the bot will answer, classified once by MyClient.classify_message:
+# kind is "dm", "airi", "prefix" or "mention", and the rest configures the shared reply pipeline
+class ChatRoute:
+    labels = {
+        "dm": "DM",
+        "airi": "Airi channel",
+        "prefix": "conversational",
+        "mention": "mention",
+    }
     
-    # Check if any pattern matches
-    for pattern in creator_patterns:
-        if pattern in message:
-            return True
-            
-    return False
+    def __init__(self, kind, message, query, location_info, reply=True, intro="", ignore_commands=False):
+        self.kind = kind
+        self.message = message
+        self.query = query
+        self.location_info = location_info
+        self.reply = reply
+        self.intro = intro
+        self.ignore_commands = ignore_commands
+        self.logged = False
+    
+    # Combine a burst of routes into one, answering the latest message with all of their text as the query
+    @classmethod
+    def merge(cls, routes):
+        if len(routes) == 1:
+            return routes[0]
+        
+        latest = routes[-1]
+        return cls(
+            latest.kind,
+            latest.message,
+            "\n".join(route.query for route in routes),
+            latest.location_info,
+            reply=latest.reply,
+            intro=latest.intro,
+            ignore_commands=latest.ignore_commands
+        )
+    
+    @property
+    def label(self):
+        return self.labels.get(self.kind, self.kind)
 
-# Function to check if channel name contains Airi variations
-def is_airi_channel(channel_name):
-    # Convert to lowercase for case-insensitive matching
-    name = channel_name.lower()
-    
-    # Patterns for Airi channel names
-    airi_patterns = [
-        "airi",
-        "ai-ri",
-        "chat-with-airi",
-        "airi-chatting"
-    ]
+# Messages from one user in one channel that are waiting to be answered together
+class ChatBatch:
+    def __init__(self):
+        self.routes = []
+        self.task = None
+
+# Debounces chat messages per (user, channel): a burst of messages becomes one Gemini call, and a new
+# message cancels a reply that is still being generated so it can be regenerated with the new text
+class ChatCoalescer:
+    def __init__(self, window):
+        self.window = window
+        self.batches = {}   # (user_id, channel_id) -> ChatBatch still accepting messages
+        self.replying = {}  # (user_id, channel_id) -> task sending a committed reply
     
-    # Check if any pattern is in the channel name
-    for pattern in airi_patterns:
-        if pattern in name:
-            return True
+    def submit(self, route):
+        key = (route.message.author.id, route.message.channel.id)
+        batch = self.batches.get(key)
+        if batch is None:
+            batch = ChatBatch()
+            self.batches[key] = batch
+        else:
+            # The earlier messages are answered together with this one instead
+            batch.task.cancel()
+        
+        batch.routes.append(route)
+        batch.task = asyncio.create_task(self.run(key, batch), name=f"reply:{route.kind}")
+    
+    async def run(self, key, batch):
+        task = asyncio.current_task()
+        
+        def commit():
+            if self.batches.get(key) is batch:
+                del self.batches[key]
+                self.replying[key] = task
+        
+        try:
+            if self.window > 0:
+                await asyncio.sleep(self.window)
             
-    return False
+            # Let the previous reply in this conversation finish first, so this one sees it in the history
+            previous = self.replying.get(key)
+            if previous is not None and previous is not task:
+                await asyncio.wait([previous])
+            
+            await client.reply_to_batch(list(batch.routes), commit)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            chat_log.exception("Error replying to chat messages: %s", e)
+        finally:
+            if self.batches.get(key) is batch and batch.task is task:
+                del self.batches[key]
+            if self.replying.get(key) is task:
+                del self.replying[key]
+    
+    # Wait up to `timeout` seconds for batches and replies in progress, then cancel whatever is left
+    async def close(self, timeout):
+        tasks = {batch.task for batch in self.batches.values()} | set(self.replying.values())
+        if not tasks:
+            return
+        _, unfinished = await asyncio.wait(tasks, timeout=timeout)
+        if unfinished:
+            chat_log.warning("Cancelling %d chat replies still running at shutdown", len(unfinished))
+            for task in unfinished:
+                task.cancel()
+            await asyncio.gather(*unfinished, return_exceptions=True)
+
+chat_coalescer = ChatCoalescer(COALESCE_WINDOW)
 
 # Create bot client
-class MyClient(discord.Client):
+# AutoShardedClient runs several gateway connections (shards) in one process
+ClientBase = discord.AutoShardedClient if SHARDED else discord.Client
+
+class MyClient(ClientBase):
     def __init__(self):
-        super().__init__(intents=intents)
-        self.synced = False
+        if SHARDED:
+            super().__init__(
+                intents=intents,
+                shard_count=int(SHARD_COUNT) if SHARD_COUNT not in ('', 'auto') else None,
+                shard_ids=SHARD_IDS or None
+            )
+        else:
+            super().__init__(intents=intents)
+        # Shared aiohttp session for outbound HTTP, created in setup_hook
+        self.http_session = None
+        # Health, lag and metrics loops started in setup_hook
+        self.background_tasks = []
+        self.metrics_runner = None
+        self.closing_task = None
         
     async def on_ready(self):
         await self.wait_until_ready()
-        if not self.synced:
-            await tree.sync()
-            self.synced = True
-        print(f'Logged in as {self.user} (ID: {self.user.id})')
-        print('------')
+        log.info("Logged in as %s (ID: %s)", self.user, self.user.id, extra={"shards": sorted(getattr(self, "shard_ids", None) or [self.shard_id or 0])})
+    
+    async def on_shard_ready(self, shard_id):
+        shard_events.inc(shard_id, "ready")
+        log.info("Shard %d ready", shard_id)
+    
+    async def on_shard_disconnect(self, shard_id):
+        shard_events.inc(shard_id, "disconnect")
+        log.warning("Shard %d disconnected", shard_id)
+    
+    async def on_shard_resumed(self, shard_id):
+        shard_events.inc(shard_id, "resumed")
+        log.info("Shard %d resumed", shard_id)
+    
+    async def setup_hook(self):
+        await self.start_services()
+        if SYNC_COMMANDS:
+            await sync_command_tree(self.application_id)
+    
+    # Everything the bot runs besides its Discord connection; loadtest.py starts the bot through this too
+    async def start_services(self):
+        await log_writer.run_db(conversation_store.open)
+        await log_writer.run_db(conversation_store.import_text_logs, logs_dir / "users")
+        log_writer.start()
+        
+        # Shut down on SIGTERM as on Ctrl+C, so queued conversation logs and the final metrics dump are written
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, self.close_on_signal)
+        except NotImplementedError:
+            # The Windows event loop doesn't support signal handlers
+            pass
+        
+        # One keep-alive connection pool for the lifetime of the client
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_MAX_CONNECTIONS,
+            limit_per_host=HTTP_MAX_CONNECTIONS_PER_HOST,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL
+        )
+        self.http_session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT),
+            trace_configs=[http_trace_config()]
+        )
+    
+        image_queue.start()
+        watchdog.start()
+        self.background_tasks.append(asyncio.create_task(self.monitor_ai_health(), name="ai-health"))
+        if METRICS_DUMP_INTERVAL > 0:
+            self.background_tasks.append(asyncio.create_task(self.dump_metrics_periodically(), name="metrics-dump"))
+        if METRICS_PORT:
+            try:
+                self.metrics_runner = await start_metrics_server()
+            except OSError as e:
+                metrics_log.error("Error starting metrics server on port %d: %s", METRICS_PORT, e)
+    
+    def close_on_signal(self):
+        log.info("Received SIGTERM, shutting down")
+        self.start_shutdown()
     
-    # Helper method to get conversation log file path
-    def get_log_file_path(self, user_id):
-        # Create a universal log file for each user: logs/users/user_id.txt
-        users_dir = logs_dir / "users"
-        users_dir.mkdir(exist_ok=True)
+    def start_shutdown(self):
+        if self.closing_task is None:
+            self.closing_task = asyncio.create_task(self.shut_down(), name="shutdown")
+        return self.closing_task
+    
+    # A signal and discord.py can both ask to close, so the shutdown itself only runs once
+    async def close(self):
+        await asyncio.shield(self.start_shutdown())
+    
+    # Stop taking new chat messages, let replies in progress finish while Discord is still connected,
+    # disconnect, and only then close what the replies use and write out the conversation logs
+    async def shut_down(self):
+        await self.stop_tasks()
+        await super().close()
+        await self.stop_services()
+    
+    # Stop background work and let chat replies in progress finish
+    async def stop_tasks(self):
+        watchdog.stop()
+        for task in self.background_tasks:
+            task.cancel()
+        await chat_coalescer.close(CHAT_DRAIN_TIMEOUT)
+        await image_queue.close()
+    
+    # Close what start_services opened, writing out queued conversation logs and metrics
+    async def stop_services(self):
+        if self.metrics_runner is not None:
+            await self.metrics_runner.cleanup()
+        if self.http_session is not None:
+            await self.http_session.close()
+        gemini_engine.shutdown()
+        await log_writer.close()
+        conversation_store.close()
+        if METRICS_DUMP_INTERVAL > 0:
+            write_metrics_dump()
+    
+    # Record slash command latency from the moment Discord created the interaction
+    async def on_app_command_completion(self, interaction, command):
+        elapsed = (discord.utils.utcnow() - interaction.created_at).total_seconds()
+        command_latency.observe(elapsed, command.qualified_name, "ok")
+    
+    async def dump_metrics_periodically(self):
+        while True:
+            await asyncio.sleep(METRICS_DUMP_INTERVAL)
+            try:
+                write_metrics_dump()
+            except OSError as e:
+                metrics_log.error("Error writing metrics to %s: %s", METRICS_DUMP_PATH, e)
+    
+    # Check Gemini in the background and turn AI features off and on with its health
+    async def monitor_ai_health(self):
+        global ai_working
         
-        return users_dir / f"{user_id}.txt"
+        if not GEMINI_API_KEY:
+            ai_working = False
+            gemini_log.warning("Gemini API key is missing; AI features are disabled")
+            return
+        
+        first_check = True
+        while True:
+            healthy, error = await gemini_engine.check_health()
+            if healthy and (first_check or not ai_working):
+                gemini_log.info("Gemini API connection successful using %s model", gemini_engine.model_name)
+            elif not healthy and (first_check or ai_working):
+                gemini_log.error(
+                    "Gemini API health check failed: %s. AI features are disabled until Gemini recovers (next check in %.0f seconds)",
+                    error, GEMINI_HEALTH_RETRY_INTERVAL
+                )
+            ai_working = healthy
+            first_check = False
+            await asyncio.sleep(GEMINI_HEALTH_INTERVAL if healthy else GEMINI_HEALTH_RETRY_INTERVAL)
     
-    # Load conversation history from log file
-    def load_conversation_history(self, user_id):
-        log_file = self.get_log_file_path(user_id)
+    # Load conversation history, from the cache when the user was active recently or from the store
+    async def load_conversation_history(self, user_id):
+        with history_load_latency.time("cache"):
+            cached = conversation_cache.get(user_id)
+        if cached is not None and not CONVERSATION_SHARED_STORE:
+            return cached
         
+        conversation_cache.start_load(user_id)
         try:
-            if log_file.exists():
-                with open(log_file, 'r', encoding='utf-8') as f:
-                    log_content = f.read()
-                
-                return log_content
-            else:
-                return ""
+            # Make sure messages still waiting in the writer queue are part of the result
+            if log_writer.has_pending(user_id):
+                await log_writer.flush()
+            
+            stored_rows = None
+            if CONVERSATION_SHARED_STORE:
+                # Other bot processes may have logged messages for this user since it was cached
+                with history_load_latency.time("validate"):
+                    stored_rows = await log_writer.run_db(conversation_store.count_turns, user_id)
+                if cached is not None and stored_rows == conversation_cache.stored_rows(user_id):
+                    return cached
+            
+            with history_load_latency.time("store"):
+                rows = await log_writer.run_db(conversation_store.last_turns, user_id, CONVERSATION_HISTORY_TURNS)
+                history = "".join(format_log_entry(*row) for row in rows)
+                return conversation_cache.put(user_id, history, stored_rows)
         except Exception as e:
-            print(f"Error loading conversation history: {e}")
-            return ""
+            store_log.error("Error loading conversation history: %s", e)
+            return cached or ""
+        finally:
+            conversation_cache.finish_load(user_id)
     
     # Add a new message to the conversation log
-    def append_to_conversation_log(self, user_id, message_info, sender, message):
-        log_file = self.get_log_file_path(user_id)
-        
+    def append_to_conversation_log(self, user_id, message_info, sender, message, sent_at=None):
         try:
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            # Log in local time, using when the message was sent if we know it
+            sent_at = sent_at.astimezone() if sent_at else datetime.now()
+            timestamp = sent_at.strftime("%Y-%m-%d %H:%M:%S")
             
-            # Create the log entry with location information
-            log_entry = f"[{timestamp}] [{message_info}] {sender}: {message}\n\n"
+            # Queue the message with its location information for the background writer
+            log_writer.write((user_id, timestamp, message_info, sender, message))
             
-            # Append to the log file
-            with open(log_file, 'a', encoding='utf-8') as f:
-                f.write(log_entry)
+            conversation_cache.append(user_id, format_log_entry(timestamp, message_info, sender, message))
                 
             return True
         except Exception as e:
-            print(f"Error appending to conversation log: {e}")
+            store_log.error("Error appending to conversation log: %s", e)
             return False
     
-    # Format conversation history for the AI context
-    def format_conversation_for_ai(self, history):
+    # Format conversation history for the AI context, keeping the most recent turns within the token budget
+    def format_conversation_for_ai(self, history, token_budget=None):
         if not history:
-            return ""
+            return ConversationContext()
         
-        # Return the full conversation history without trimming
-        return history
-    
-    # Function to filter out log content from responses
-    def clean_response(self, response_text):
-        # Check if the response accidentally includes log-formatted content
-        if re.search(r'\[\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}\]', response_text):
-            print("Warning: Bot response contained log-like timestamp format. Cleaning response.")
-            
-            # Extract only the meaningful part of the response
-            # Look for patterns that indicate it's trying to repeat conversation history
-            lines = response_text.split('\n')
-            cleaned_lines = []
-            
-            # Skip log-formatted lines and history markers
-            skip_line = False
-            for line in lines:
-                # Skip timestamp lines
-                if re.search(r'\[\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}\]', line):
-                    skip_line = True
-                    continue
-                    
-                # Skip lines that look like log entries
-                if re.search(r'\[.*\] (USER|BOT):', line):
-                    skip_line = True
-                    continue
-                    
-                # Skip lines that are clearly indicating history
-                if any(marker in line.lower() for marker in [
-                    "conversation history", 
-                    "chat history",
-                    "previous messages",
-                    "our conversation",
-                    "earlier conversation",
-                    "from our previous"
-                ]):
-                    skip_line = True
-                    continue
-                    
-                # If we're skipping but encounter an empty line, stop skipping
-                if skip_line and not line.strip():
-                    skip_line = False
-                    continue
-                    
-                # Add non-skipped lines
-                if not skip_line:
-                    cleaned_lines.append(line)
-            
-            # If we filtered out too much, look for the actual response at the end
-            if not cleaned_lines or "".join(cleaned_lines).strip() == "":
-                # Try to find the actual response by looking for the last portion after timestamps
-                parts = re.split(r'\[\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}\].*?(?=\n|$)', response_text)
-                if parts and parts[-1].strip():
-                    cleaned_response = parts[-1].strip()
-                else:
-                    # Fallback if nothing works
-                    cleaned_response = "I understand your message, but I'm having trouble formulating a proper response. Could you try asking again in a different way?"
-            else:
-                cleaned_response = "\n".join(cleaned_lines)
-                
-            return cleaned_response.strip()
+        token_budget = token_budget or CONTEXT_TOKEN_BUDGET
+        entries = split_log_entries(history)
         
-        return response_text
-
+        # Take turns from the newest backwards until the budget is spent
+        kept = []
+        used = 0
+        for entry in reversed(entries):
+            cost = estimate_tokens(entry)
+            if used + cost > token_budget:
+                if kept:
+                    break
+                # The newest turn alone is over budget, so keep only its end
+                entry = truncate_log_entry(entry, token_budget)
+                cost = estimate_tokens(entry)
+            kept.append(entry)
+            used += cost
+        kept.reverse()
+        
+        summary = ""
+        while CONTEXT_SUMMARY and len(kept) < len(entries):
+            summary_budget = CONTEXT_SUMMARY_TOKENS
+            if len(kept) <= 1:
+                # Only the newest turn is left, so the summary gets whatever room it leaves (possibly none)
+                summary_budget = min(summary_budget, token_budget - used)
+            summary = summarize_dropped_turns(entries[:len(entries) - len(kept)], summary_budget)
+            if len(kept) <= 1 or used + estimate_tokens(summary) <= token_budget:
+                break
+            # Make room for the summary by letting go of the oldest kept turn
+            used -= estimate_tokens(kept.pop(0))
+        
+        return ConversationContext(
+            text=summary + "".join(kept),
+            turns_included=len(kept),
+            turns_total=len(entries),
+            summarized_turns=len(entries) - len(kept) if summary else 0
+        )
+    
     async def on_message(self, message):
-        # Don't respond to our own messages
-        if message.author == self.user:
+        # Don't respond to our own messages, or to anything once shutdown has started
+        if message.author == self.user or self.closing_task is not None:
             return
-            
+        
+        shard_messages.inc(message.guild.shard_id if message.guild else 0)
+        
+        route = self.classify_message(message)
+        if route is None:
+            return
+        
+        # Name the task so the event loop watchdog can tell which route it was running
+        name_current_task(f"route:{route.kind}")
+        await self.handle_chat(route)
+    
+    # Decide whether and how to answer a message; returns a ChatRoute, or None to ignore the message
+    def classify_message(self, message):
         # Handle DMs - respond to all messages without prefix or mention
         if isinstance(message.channel, discord.DMChannel):
             query = message.content.strip()
             
             # Skip empty messages
             if not query:
-                return
-            
-            # Check if asking about creator
-            if is_asking_about_creator(query):
-                creator_response = "A really boring and techy guy named Julkarnain created me. You can contact him here: https://facebook.com/julkarnainx"
-                
-                # Log the user's message
-                location_info = "Direct Message"
-                self.append_to_conversation_log(
-                    message.author.id,
-                    location_info,
-                    "USER",
-                    query
-                )
-                
-                # Send the creator response
-                await message.channel.send(creator_response)
-                
-                # Log the bot's response
-                self.append_to_conversation_log(
-                    message.author.id,
-                    location_info,
-                    "BOT",
-                    creator_response
-                )
-                
-                return
-                
-            # Send "typing" indicator
-            async with message.channel.typing():
-                if ai_working:
-                    try:
-                        location_info = "Direct Message"
-                        
-                        # Load this user's conversation history
-                        conversation_history = self.load_conversation_history(message.author.id)
-                        
-                        # Format for AI context
-                        context = self.format_conversation_for_ai(conversation_history)
-                        
-                        # Log the user's message before generating a response
-                        self.append_to_conversation_log(
-                            message.author.id,
-                            location_info,
-                            "USER",
-                            query
-                        )
-                        
-                        # Call Gemini API with conversation history included
-                        prompt = f"""You are responding as a friendly, casual person in a Discord chat. 
-                        Keep your response conversational, relatable, and authentic, like a real friend would talk.
-                        Use some casual language, emoji, or slang where appropriate, but don't overdo it.
-                        Avoid sounding formal or robotic. Don't mention AI, models or prompts.
-                        
-                        I'll provide you with conversation history with this user, but DO NOT repeat or reference the 
-                        raw log format in your response. Your response should be natural and not quote timestamp entries.
-                        Do not include any timestamps or log markers like [2023-01-01 12:00:00] in your response.
-                        
-                        Here is the conversation history with this user for context only:
-                        {context}
-                        
-                        The user is currently messaging in {location_info}.
-                        
-                        Respond ONLY with your direct reply to: "{query}"
-                        Do not include or repeat the conversation history in your response.
-                        """
-                        
-                        response = gemini_model.generate_content(prompt)
-                        reply_text = response.text
-                        
-                        # Clean the response to remove any log-like content
-                        reply_text = self.clean_response(reply_text)
-                        
-                        # Trim if too long
-                        if len(reply_text) > 2000:
-                            reply_text = reply_text[:1997] + "..."
-                        
-                        # Send the response as a normal message, not a reply
-                        await message.channel.send(reply_text)
-                        
-                        # Log the bot's response
-                        self.append_to_conversation_log(
-                            message.author.id,
-                            location_info,
-                            "BOT",
-                            reply_text
-                        )
-                        
-                    except Exception as e:
-                        print(f"Error generating DM response: {str(e)}")
-                        traceback.print_exc()
-                        await message.channel.send("Sorry, I'm having trouble thinking right now. Try again later?")
-                else:
-                    await message.channel.send("Sorry, I can't chat right now. Try again later?")
-                
-            # Return early for DMs to avoid checking other conditions
-            return
+                return None
             
-        # Check if the channel name contains Airi
-        if message.guild and is_airi_channel(message.channel.name):
-            # Process messages in Airi channels without requiring prefix, mention or reply
+            return ChatRoute("dm", message, query, "Direct Message", reply=False)
+        
+        # Process messages in Airi channels without requiring prefix, mention or reply
+        if message.guild and is_airi_channel(message.channel):
             query = message.content.strip()
             
             # Skip empty messages
             if not query:
-                return
-                
-            # Check if asking about creator
-            if is_asking_about_creator(query):
-                creator_response = "A really boring and techy guy named Julkarnain created me. You can contact him here: https://facebook.com/julkarnainx"
-                
-                # Get message location info
-                location_info = f"Server: {message.guild.name}, Channel: {message.channel.name} (Airi channel)"
-                
-                # Log the user's message
-                self.append_to_conversation_log(
-                    message.author.id,
-                    location_info,
-                    "USER",
-                    query
-                )
-                
-                # Send the creator response
-                await message.reply(creator_response)
-                
-                # Log the bot's response
-                self.append_to_conversation_log(
-                    message.author.id,
-                    location_info,
-                    "BOT",
-                    creator_response
-                )
-                
-                return
-                
-            # Skip messages with command prefixes, as these might be intended for other bots
-            if message.content.startswith(('/', '!', '?', '-', '>')):
-                return
-                
-            # Send "typing" indicator
-            async with message.channel.typing():
-                if ai_working:
-                    try:
-                        # Get message location info
-                        location_info = f"Server: {message.guild.name}, Channel: {message.channel.name} (Airi channel)"
-                        
-                        # Load this user's conversation history (universal)
-                        conversation_history = self.load_conversation_history(message.author.id)
-                        
-                        # Format for AI context
-                        context = self.format_conversation_for_ai(conversation_history)
-                        
-                        # Log the user's message before generating a response
-                        self.append_to_conversation_log(
-                            message.author.id,
-                            location_info,
-                            "USER",
-                            query
-                        )
-                        
-                        # Call Gemini API with conversation history included
-                        prompt = f"""You are responding as a friendly, casual person in a Discord chat.
-                        You're in a channel specifically for chatting with you.
-                        Keep your response conversational, relatable, and authentic, like a real friend would talk.
-                        Use some casual language, emoji, or slang where appropriate, but don't overdo it.
-                        Avoid sounding formal or robotic. Don't mention AI, models or prompts.
-                        
-                        I'll provide you with conversation history with this user, but DO NOT repeat or reference the 
-                        raw log format in your response. Your response should be natural and not quote timestamp entries.
-                        Do not include any timestamps or log markers like [2023-01-01 12:00:00] in your response.
-                        
-                        Here is the conversation history with this user for context only:
-                        {context}
-                        
-                        The user is currently messaging in {location_info}.
-                        
-                        Respond ONLY with your direct reply to: "{query}"
-                        Do not include or repeat the conversation history in your response.
-                        """
-                        
-                        response = gemini_model.generate_content(prompt)
-                        reply_text = response.text
-                        
-                        # Clean the response to remove any log-like content
-                        reply_text = self.clean_response(reply_text)
-                        
-                        # Trim if too long
-                        if len(reply_text) > 2000:
-                            reply_text = reply_text[:1997] + "..."
-                        
-                        # Send the response as a reply
-                        await message.reply(reply_text)
-                        
-                        # Log the bot's response
-                        self.append_to_conversation_log(
-                            message.author.id,
-                            location_info,
-                            "BOT",
-                            reply_text
-                        )
-                        
-                    except Exception as e:
-                        print(f"Error generating Airi channel response: {str(e)}")
-                        traceback.print_exc()
-                        await message.reply("Sorry, I'm having trouble thinking right now. Try again later?")
-                else:
-                    await message.reply("Sorry, I can't chat right now. Try again later?")
-                    
-            # Return early after processing in Airi channels
-            return
+                return None
             
+            return ChatRoute(
+                "airi",
+                message,
+                query,
+                f"Server: {message.guild.name}, Channel: {message.channel.name} (Airi channel)",
+                intro="You're in a channel specifically for chatting with you.",
+                ignore_commands=True
+            )
+        
+        # Get message location info
+        if message.guild:
+            location_info = f"Server: {message.guild.name}, Channel: {message.channel.name}"
+        else:
+            location_info = "Direct Message"
+        
         # Check if the message starts with "." (prefix for conversational responses)
         if message.content.startswith('.'):
             # Get the message content without the prefix
@@ -460,116 +2122,16 @@ class MyClient(discord.Client):
             
             # Skip empty messages
             if not query:
-                return
+                return None
             
-            # Check if asking about creator
-            if is_asking_about_creator(query):
-                creator_response = "A really boring and techy guy named Julkarnain created me. You can contact him here: https://facebook.com/julkarnainx"
-                
-                # Get message location info
-                if message.guild:
-                    location_info = f"Server: {message.guild.name}, Channel: {message.channel.name}"
-                else:
-                    location_info = "Direct Message"
-                
-                # Log the user's message
-                self.append_to_conversation_log(
-                    message.author.id,
-                    location_info,
-                    "USER",
-                    query
-                )
-                
-                # Send the creator response
-                await message.reply(creator_response)
-                
-                # Log the bot's response
-                self.append_to_conversation_log(
-                    message.author.id,
-                    location_info,
-                    "BOT",
-                    creator_response
-                )
-                
-                return
-                
-            # Send "typing" indicator
-            async with message.channel.typing():
-                if ai_working:
-                    try:
-                        # Get message location info
-                        if message.guild:
-                            location_info = f"Server: {message.guild.name}, Channel: {message.channel.name}"
-                        else:
-                            location_info = "Direct Message"
-                        
-                        # Load this user's conversation history (universal)
-                        conversation_history = self.load_conversation_history(message.author.id)
-                        
-                        # Format for AI context
-                        context = self.format_conversation_for_ai(conversation_history)
-                        
-                        # Log the user's message before generating a response
-                        self.append_to_conversation_log(
-                            message.author.id,
-                            location_info,
-                            "USER",
-                            query
-                        )
-                        
-                        # Call Gemini API with conversation history included
-                        prompt = f"""You are responding as a friendly, casual person in a Discord chat. 
-                        Keep your response conversational, relatable, and authentic, like a real friend would talk.
-                        Use some casual language, emoji, or slang where appropriate, but don't overdo it.
-                        Avoid sounding formal or robotic. Don't mention AI, models or prompts.
-                        
-                        I'll provide you with conversation history with this user, but DO NOT repeat or reference the 
-                        raw log format in your response. Your response should be natural and not quote timestamp entries.
-                        Do not include any timestamps or log markers like [2023-01-01 12:00:00] in your response.
-                        
-                        Here is the conversation history with this user for context only:
-                        {context}
-                        
-                        The user is currently messaging in {location_info}.
-                        
-                        Respond ONLY with your direct reply to: "{query}"
-                        Do not include or repeat the conversation history in your response.
-                        """
-                        
-                        response = gemini_model.generate_content(prompt)
-                        reply_text = response.text
-                        
-                        # Clean the response to remove any log-like content
-                        reply_text = self.clean_response(reply_text)
-                        
-                        # Trim if too long
-                        if len(reply_text) > 2000:
-                            reply_text = reply_text[:1997] + "..."
-                        
-                        # Send the response
-                        await message.reply(reply_text)
-                        
-                        # Log the bot's response
-                        self.append_to_conversation_log(
-                            message.author.id,
-                            location_info,
-                            "BOT",
-                            reply_text
-                        )
-                        
-                    except Exception as e:
-                        print(f"Error generating conversational response: {str(e)}")
-                        traceback.print_exc()
-                        await message.reply("Sorry, I'm having trouble thinking right now. Try again later?")
-                else:
-                    await message.reply("Sorry, I can't chat right now. Try again later?")
+            return ChatRoute("prefix", message, query, location_info)
         
         # Check if the bot was mentioned or if the message is a reply to the bot's message
-        elif self.user.mentioned_in(message) or (message.reference and message.reference.resolved and message.reference.resolved.author.id == self.user.id):
+        if self.user.mentioned_in(message) or (message.reference and message.reference.resolved and message.reference.resolved.author.id == self.user.id):
             # Skip messages with command prefixes, as these might be intended for other bots
-            if message.content.startswith(('/', '!', '?', '-', '>')):
-                return
-                
+            if message.content.startswith(command_prefixes):
+                return None
+            
             # Get the content - remove the mention for cleaner input
             query = message.content.replace(f'<@{self.user.id}>', '').strip()
             if not query and message.reference:
@@ -579,71 +2141,184 @@ class MyClient(discord.Client):
                 # If they just pinged the bot with no content, use their greeting as context
                 query = "hello"
             
-            # Check if asking about creator
-            if is_asking_about_creator(query):
-                creator_response = "A really boring and techy guy named Julkarnain created me. You can contact him here: https://facebook.com/julkarnainx"
-                
-                # Get message location info
-                if message.guild:
-                    location_info = f"Server: {message.guild.name}, Channel: {message.channel.name}"
-                else:
-                    location_info = "Direct Message"
-                    
-                # Log the user's message
-                self.append_to_conversation_log(
-                    message.author.id,
-                    location_info,
-                    "USER",
-                    query
-                )
-                
-                # Send the creator response
-                await message.reply(creator_response)
+            direct_context = ""
+            # If it's a reply to the bot, add the original message as context
+            if message.reference and message.reference.resolved:
+                original_message = message.reference.resolved
+                if original_message.author.id == self.user.id:
+                    direct_context = f"This is a reply to your previous message where you said: '{original_message.content}'. "
+            
+            return ChatRoute(
+                "mention",
+                message,
+                query,
+                location_info,
+                intro=f"{direct_context}Someone has mentioned you or replied to your message."
+            )
+        
+        return None
+    
+    # Shared pipeline for every chat route: creator question, then generate, send and log a reply
+    async def handle_chat(self, route):
+        message = route.message
+        chat_messages.inc(route.kind)
+        
+        # Check if asking about creator
+        if is_asking_about_creator(route.query):
+            await self.send_creator_response(route)
+            return
+        
+        # Skip messages with command prefixes, as these might be intended for other bots
+        if route.ignore_commands and message.content.startswith(command_prefixes):
+            return
+        
+        # Wait briefly for follow-up messages, then answer them together
+        chat_coalescer.submit(route)
+    
+    # Generate, send and log one reply for a burst of messages from the same user in the same channel.
+    # `commit` is called once the reply is about to be sent; until then a newer message may cancel this batch.
+    async def reply_to_batch(self, routes, commit):
+        started = time.perf_counter()
+        status = "cancelled"
+        try:
+            status = await self.answer_batch(routes, commit)
+        finally:
+            chat_reply_latency.observe(time.perf_counter() - started, routes[-1].kind, status)
+    
+    # Does the work of reply_to_batch and returns how it went, for metrics
+    async def answer_batch(self, routes, commit):
+        route = ChatRoute.merge(routes)
+        message = route.message
+        
+        # Send "typing" indicator
+        async with message.channel.typing():
+            if not ai_working:
+                commit()
+                await self.send_reply(route, "Sorry, I can't chat right now. Try again later?")
+                return "ai_unavailable"
+            
+            # Turn the request away quickly when the user, server or bot is over its AI limit
+            scope, retry_after = admission.admit(message.author.id, message.guild.id if message.guild else None)
+            if scope is not None:
+                commit()
+                self.log_user_messages(routes)
+                await self.send_reply(route, admission_rejection_message(scope, retry_after))
+                return "rate_limited"
+            
+            # Once the first text is shown the batch can no longer be cancelled by a newer message
+            def before_send():
+                commit()
+                # Log the user's messages now that they won't be merged into a newer batch
+                self.log_user_messages(routes)
+            
+            streamed = StreamingReply(
+                lambda text, file=None: self.send_reply(route, text, file=file),
+                edit_message,
+                send_more=message.channel.send,
+                before_send=before_send
+            )
+            
+            try:
+                reply_text = await self.generate_reply(route, on_text=streamed.update if STREAM_RESPONSES else None)
+                await streamed.finish(reply_text)
                 
                 # Log the bot's response
                 self.append_to_conversation_log(
                     message.author.id,
-                    location_info,
+                    route.location_info,
                     "BOT",
-                    creator_response
+                    reply_text
                 )
+                return "ok"
                 
-                return
+            except BackendUnavailable as e:
+                commit()
+                self.log_user_messages(routes)
+                chat_log.warning("Skipped %s response: %s", route.label, e)
+                await self.send_reply(route, f"Sorry, I can't think straight right now. Try again in {max(1, round(e.retry_after))} seconds?")
+                return "backend_unavailable"
+            except Exception as e:
+                commit()
+                self.log_user_messages(routes)
+                chat_log.exception("Error generating %s response: %s", route.label, e)
+                await self.send_reply(route, "Sorry, I'm having trouble thinking right now. Try again later?")
+                return "error"
+    
+    def log_user_messages(self, routes):
+        for route in routes:
+            if route.logged:
+                continue
+            self.append_to_conversation_log(
+                route.message.author.id,
+                route.location_info,
+                "USER",
+                route.query,
+                sent_at=route.message.created_at
+            )
+            route.logged = True
+    
+    async def send_creator_response(self, route):
+        creator_response = "A really boring and techy guy named Julkarnain created me. You can contact him here: https://facebook.com/julkarnainx"
+        
+        # Log the user's message
+        self.append_to_conversation_log(
+            route.message.author.id,
+            route.location_info,
+            "USER",
+            route.query
+        )
+        
+        # Send the creator response
+        await self.send_reply(route, creator_response)
+        
+        # Log the bot's response
+        self.append_to_conversation_log(
+            route.message.author.id,
+            route.location_info,
+            "BOT",
+            creator_response
+        )
+    
+    # Load the user's history and ask Gemini for a cleaned reply.
+    # With `on_text`, the reply is streamed and on_text is awaited with the cleaned text so far.
+    async def generate_reply(self, route, on_text=None):
+        user_id = route.message.author.id
+        
+        # Load this user's conversation history (universal)
+        conversation_history = await self.load_conversation_history(user_id)
+        
+        # Format for AI context
+        context = self.format_conversation_for_ai(conversation_history)
+        chat_log.debug(
+            "Conversation context for user %s", user_id,
+            extra={"turns_included": context.turns_included, "turns_total": context.turns_total, "tokens": context.tokens}
+        )
+        
+        prompt = self.build_prompt(route, context)
+        
+        if on_text is None:
+            # Call Gemini API with conversation history included
+            reply_text = await gemini_engine.generate(prompt)
             
-            # Send "typing" indicator
-            async with message.channel.typing():
-                if ai_working:
-                    try:
-                        # Get message location info
-                        if message.guild:
-                            location_info = f"Server: {message.guild.name}, Channel: {message.channel.name}"
-                        else:
-                            location_info = "Direct Message"
-                        
-                        # Load this user's conversation history (universal)
-                        conversation_history = self.load_conversation_history(message.author.id)
-                        
-                        # Format for AI context
-                        context = self.format_conversation_for_ai(conversation_history)
-                        
-                        direct_context = ""
-                        # If it's a reply to the bot, add the original message as context
-                        if message.reference and message.reference.resolved:
-                            original_message = message.reference.resolved
-                            if original_message.author.id == self.user.id:
-                                direct_context = f"This is a reply to your previous message where you said: '{original_message.content}'. "
-                        
-                        # Log the user's message before generating a response
-                        self.append_to_conversation_log(
-                            message.author.id,
-                            location_info,
-                            "USER",
-                            query
-                        )
-                        
-                        # Call Gemini API with a prompt to act like a casual, friendly human
-                        prompt = f"""You are responding as a friendly, casual person in a Discord chat.
-                        {direct_context}Someone has mentioned you or replied to your message. 
+            # Clean the response to remove any log-like content
+            reply_text = clean_response(reply_text)
+        else:
+            # Stream the reply, cleaning log-like content as it arrives
+            sanitizer = ResponseSanitizer()
+            stream = gemini_engine.stream(prompt)
+            try:
+                async for chunk in stream:
+                    sanitizer.feed(chunk)
+                    await on_text(sanitizer.text())
+            finally:
+                await stream.aclose()
+            reply_text = sanitizer.finish()
+        
+        return reply_text
+    
+    def build_prompt(self, route, context):
+        intro = f"\n                        {route.intro}" if route.intro else ""
+        return f"""You are responding as a friendly, casual person in a Discord chat.{intro}
                         Keep your response conversational, relatable, and authentic, like a real friend would talk.
                         Use some casual language, emoji, or slang where appropriate, but don't overdo it.
                         Avoid sounding formal or robotic. Don't mention AI, models or prompts.
@@ -653,44 +2328,75 @@ class MyClient(discord.Client):
                         Do not include any timestamps or log markers like [2023-01-01 12:00:00] in your response.
                         
                         Here is the conversation history with this user for context only:
-                        {context}
+                        {context.text}
                         
-                        The user is currently messaging in {location_info}.
+                        The user is currently messaging in {route.location_info}.
                         
-                        Respond ONLY with your direct reply to: "{query}"
+                        Respond ONLY with your direct reply to: "{route.query}"
                         Do not include or repeat the conversation history in your response.
                         """
-                        
-                        response = gemini_model.generate_content(prompt)
-                        reply_text = response.text
-                        
-                        # Clean the response to remove any log-like content
-                        reply_text = self.clean_response(reply_text)
-                        
-                        # Trim if too long
-                        if len(reply_text) > 2000:
-                            reply_text = reply_text[:1997] + "..."
-                        
-                        # Send the response
-                        await message.reply(reply_text)
-                        
-                        # Log the bot's response
-                        self.append_to_conversation_log(
-                            message.author.id,
-                            location_info,
-                            "BOT",
-                            reply_text
-                        )
-                        
-                    except Exception as e:
-                        print(f"Error generating mention response: {str(e)}")
-                        traceback.print_exc()
-                        await message.reply("Sorry, I'm having trouble thinking right now. Try again later?")
-                else:
-                    await message.reply("Sorry, I can't chat right now. Try again later?")
+    
+    # DMs get a normal message; everywhere else the bot replies to the user's message
+    async def send_reply(self, route, text, file=None):
+        if route.reply:
+            return await route.message.reply(text, file=file)
+        return await route.message.channel.send(text, file=file)
+
+# Names each command's task after the command, for the event loop watchdog
+class InstrumentedCommandTree(app_commands.CommandTree):
+    async def interaction_check(self, interaction):
+        if interaction.command is not None:
+            name_current_task(f"command:{interaction.command.qualified_name}")
+        return True
 
 client = MyClient()
-tree = app_commands.CommandTree(client)
+tree = InstrumentedCommandTree(client)
+
+# Record failed slash commands and log the error like the default handler does
+@tree.error
+async def on_app_command_error(interaction, error):
+    command = interaction.command
+    name = command.qualified_name if command is not None else "unknown"
+    elapsed = (discord.utils.utcnow() - interaction.created_at).total_seconds()
+    command_latency.observe(elapsed, name, type(getattr(error, "original", error)).__name__)
+    commands_log.error("Ignoring exception in command %r", name, exc_info=error)
+
+# Hash of the commands Discord would receive for the scope, to tell when they need syncing again
+def command_tree_hash(guild=None):
+    commands = sorted((cmd.to_dict() for cmd in tree.get_commands(guild=guild)), key=lambda cmd: (cmd["type"], cmd["name"]))
+    return hashlib.sha256(json.dumps(commands, sort_keys=True).encode('utf-8')).hexdigest()
+
+# Sync slash commands only when they changed since the last sync recorded in COMMAND_SYNC_STATE_PATH.
+# With DEV_GUILD_IDS set, commands are synced to those servers only, where they show up straight away.
+async def sync_command_tree(application_id):
+    try:
+        state = json.loads(COMMAND_SYNC_STATE_PATH.read_text())
+    except (OSError, ValueError):
+        state = {}
+    
+    guilds = [discord.Object(id=guild_id) for guild_id in DEV_GUILD_IDS] or [None]
+    for guild in guilds:
+        if guild is not None:
+            tree.copy_global_to(guild=guild)
+        scope = "global" if guild is None else f"guild {guild.id}"
+        key = f"{application_id}:{scope}"
+        digest = command_tree_hash(guild)
+        
+        if state.get(key) == digest and not FORCE_COMMAND_SYNC:
+            commands_log.info("Slash commands unchanged (%s), skipping sync", scope)
+            continue
+        
+        try:
+            synced = await tree.sync(guild=guild)
+        except discord.HTTPException as e:
+            commands_log.error("Error syncing slash commands (%s): %s", scope, e)
+            continue
+        commands_log.info("Synced %d slash commands (%s)", len(synced), scope)
+        
+        state[key] = digest
+        temp_path = COMMAND_SYNC_STATE_PATH.with_suffix(".tmp")
+        temp_path.write_text(json.dumps(state, indent=2, sort_keys=True))
+        os.replace(temp_path, COMMAND_SYNC_STATE_PATH)
 
 # Define slash commands
 @tree.command(name="hello", description="Says hello to you")
@@ -787,7 +2493,7 @@ async def clear_command(interaction: discord.Interaction, amount: int = 5):
     except discord.errors.Forbidden:
         await interaction.followup.send("I don't have permission to delete some of these messages.", ephemeral=True)
     except Exception as e:
-        print(f"Error deleting messages: {str(e)}")
+        commands_log.error("Error deleting messages: %s", e)
         await interaction.followup.send(f"An error occurred while deleting messages: {str(e)}", ephemeral=True)
 
 # Help command
@@ -839,6 +2545,12 @@ async def help_command(interaction: discord.Interaction):
     )
     embed.add_field(name="🤖 AI Features", value=ai_commands, inline=False)
     
+    # Service Status Section
+    service_status = "\n".join(
+        f"**{breaker.label.capitalize()}** - {breaker.describe()}" for breaker in circuit_breakers.values()
+    )
+    embed.add_field(name="🩺 Service Status", value=service_status, inline=False)
+    
     # Examples Section
     examples = (
         "`/meme_category programming` - Get a programming meme\n"
@@ -861,97 +2573,235 @@ async def help_command(interaction: discord.Interaction):
     
     await interaction.response.send_message(embed=embed)
 
+# Answers to /tlme questions keyed by normalized question. With a similarity threshold above 0, questions
+# are also compared by hashed word and character trigram vectors to reuse answers for near-duplicates.
+class ResponseCache:
+    dimensions = 1 << 16
+    
+    def __init__(self, ttl, max_entries, similarity=0):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.similarity = similarity
+        self.entries = OrderedDict()  # key -> (expires_at, vector, response)
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+    
+    # Only case, spacing and trailing punctuation are ignored; symbols like + # / can change the question
+    @staticmethod
+    def normalize(question):
+        return " ".join(question.lower().split()).rstrip("?!. ")
+    
+    # Unit-length sparse vector of hashed words and character trigrams
+    @classmethod
+    def vectorize(cls, key):
+        features = key.split()
+        padded = f" {key} "
+        features += [padded[i:i + 3] for i in range(len(padded) - 2)]
+        
+        vector = {}
+        for feature in features:
+            bucket = zlib.crc32(feature.encode('utf-8')) % cls.dimensions
+            vector[bucket] = vector.get(bucket, 0) + 1
+        norm = math.sqrt(sum(count * count for count in vector.values())) or 1
+        return {bucket: count / norm for bucket, count in vector.items()}
+    
+    def get(self, question):
+        key = self.normalize(question)
+        now = time.time()
+        cached = self.entries.get(key)
+        if cached is not None and cached[0] > now:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return cached[2]
+        
+        if self.similarity > 0 and key:
+            vector = self.vectorize(key)
+            best_key, best_score = None, self.similarity
+            for other_key, (expires_at, other_vector, _) in self.entries.items():
+                if expires_at <= now:
+                    continue
+                score = sum(weight * other_vector.get(bucket, 0) for bucket, weight in vector.items())
+                if score >= best_score:
+                    best_key, best_score = other_key, score
+            if best_key is not None:
+                self.entries.move_to_end(best_key)
+                self.similar_hits += 1
+                return self.entries[best_key][2]
+        
+        self.misses += 1
+        return None
+    
+    def put(self, question, response):
+        key = self.normalize(question)
+        if not key or not response.strip():
+            return
+        vector = self.vectorize(key) if self.similarity > 0 else None
+        self.entries[key] = (time.time() + self.ttl, vector, response)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+tlme_cache = ResponseCache(TLME_CACHE_TTL, TLME_CACHE_SIZE, TLME_CACHE_SIMILARITY)
+
 # Gemini integration
 @tree.command(name="tlme", description="Ask a question and get an AI-powered response using Google's Gemini 2.0 Flash")
 @app_commands.describe(question="The question or prompt you want to ask")
 async def tlme_command(interaction: discord.Interaction, question: str):
     global ai_working
     
-    if not ai_working:
-        await interaction.response.send_message(
-            "Sorry, the AI response feature is currently unavailable. Please check the Gemini API key and try again later.", 
-            ephemeral=True
-        )
-        return
+    # Answers from the cache don't use the model, so they're served even while the AI is down
+    # and don't count against the AI limits
+    cached_text = tlme_cache.get(question)
+    if cached_text is None:
+        if not ai_working:
+            await interaction.response.send_message(
+                "Sorry, the AI response feature is currently unavailable. Please check the Gemini API key and try again later.", 
+                ephemeral=True
+            )
+            return
+        
+        try:
+            gemini_engine.breaker.check()
+        except BackendUnavailable as e:
+            await interaction.response.send_message(str(e), ephemeral=True)
+            return
+        
+        scope, retry_after = admission.admit(interaction.user.id, interaction.guild_id)
+        if scope is not None:
+            await interaction.response.send_message(admission_rejection_message(scope, retry_after), ephemeral=True)
+            return
 
     await interaction.response.defer(thinking=True)
     
-    try:
-        # Call Gemini API
-        response = gemini_model.generate_content(question)
-        
-        # Format and trim the response if needed
-        response_text = response.text
-        if len(response_text) > 4000:
-            response_text = response_text[:3997] + "..."
-        
-        # Create an embed for the response
+    # Create an embed for the response
+    def build_embed(response_text):
         embed = discord.Embed(
             title="Gemini 2.0 Flash Response",
             description=response_text,
             color=discord.Color.blue()
         )
         embed.set_footer(text=f"Question by {interaction.user.display_name}", icon_url=interaction.user.display_avatar.url)
+        return embed
+    
+    # Edit the "thinking" message (message=None) or a follow-up, optionally attaching `file`
+    async def edit_embed(message, text, file=None):
+        edit = interaction.edit_original_response if message is None else message.edit
+        if file is not None:
+            return await edit(embed=build_embed(text), attachments=[file])
+        return await edit(embed=build_embed(text))
+    
+    # The answer replaces the "thinking" message; long answers continue in follow-up embeds
+    reply = StreamingReply(
+        lambda text, file=None: edit_embed(None, text, file=file),
+        edit_embed,
+        send_more=lambda text: interaction.followup.send(embed=build_embed(text), wait=True),
+        limit=4000
+    )
+    
+    try:
+        if cached_text is not None:
+            await reply.finish(cached_text)
+            return
         
-        await interaction.followup.send(embed=embed)
+        if STREAM_RESPONSES:
+            response_text = ""
+            stream = gemini_engine.stream(question)
+            try:
+                async for chunk in stream:
+                    response_text += chunk
+                    await reply.update(response_text)
+            finally:
+                await stream.aclose()
+        else:
+            # Call Gemini API
+            response_text = await gemini_engine.generate(question)
+        await reply.finish(response_text)
+        tlme_cache.put(question, response_text)
         
+    except BackendUnavailable as e:
+        gemini_log.warning("Gemini API Error: %s", e)
+        await interaction.followup.send(str(e), ephemeral=True)
+    except asyncio.TimeoutError:
+        gemini_log.error("Gemini API Error: request timed out after %s seconds", gemini_engine.timeout)
+        await interaction.followup.send("Sorry, the AI took too long to respond. Please try again later.", ephemeral=True)
     except Exception as e:
         error_message = str(e)
-        print(f"Gemini API Error: {error_message}")
+        gemini_log.error("Gemini API Error: %s", error_message)
         
         user_message = f"Sorry, I encountered an error when generating a response: {error_message}"
         await interaction.followup.send(user_message, ephemeral=True)
 
 # New meme commands
+MEME_API_URL = "https://meme-api.com/gimme"
+CAT_API_URL = "https://api.thecatapi.com/v1/images/search"
+DOG_API_URL = "https://api.thedogapi.com/v1/images/search"
+
+# GET a JSON API through its circuit breaker; returns (status, data), with data None unless the status is 200.
+# Rate limiting and server errors count as failures of the service.
+async def fetch_backend_json(breaker, url):
+    with breaker.guard() as call:
+        async with client.http_session.get(url) as response:
+            if response.status == 429 or response.status >= 500:
+                call.fail()
+            data = await response.json() if response.status == 200 else None
+            return response.status, data
+
 @tree.command(name="meme", description="Get a random meme from Reddit")
 async def meme_command(interaction: discord.Interaction):
     await interaction.response.defer()
-    async with aiohttp.ClientSession() as session:
-        async with session.get('https://meme-api.com/gimme') as response:
-            if response.status == 200:
-                data = await response.json()
-                embed = discord.Embed(
-                    title=data['title'],
-                    url=data['postLink'],
-                    color=discord.Color.random()
-                )
-                embed.set_image(url=data['url'])
-                embed.set_footer(text=f"👍 {data['ups']} | From r/{data['subreddit']}")
-                await interaction.followup.send(embed=embed)
-            else:
-                await interaction.followup.send("Couldn't fetch a meme right now. Try again later.")
+    try:
+        status, data = await fetch_backend_json(circuit_breakers["meme-api"], MEME_API_URL)
+    except BackendUnavailable as e:
+        await interaction.followup.send(str(e))
+        return
+    if status == 200:
+        embed = discord.Embed(
+            title=data['title'],
+            url=data['postLink'],
+            color=discord.Color.random()
+        )
+        embed.set_image(url=data['url'])
+        embed.set_footer(text=f"👍 {data['ups']} | From r/{data['subreddit']}")
+        await interaction.followup.send(embed=embed)
+    else:
+        await interaction.followup.send("Couldn't fetch a meme right now. Try again later.")
 
 @tree.command(name="cat", description="Get a random cat picture")
 async def cat_command(interaction: discord.Interaction):
     await interaction.response.defer()
-    async with aiohttp.ClientSession() as session:
-        async with session.get('https://api.thecatapi.com/v1/images/search') as response:
-            if response.status == 200:
-                data = await response.json()
-                embed = discord.Embed(
-                    title="Random Cat",
-                    color=discord.Color.gold()
-                )
-                embed.set_image(url=data[0]['url'])
-                await interaction.followup.send(embed=embed)
-            else:
-                await interaction.followup.send("Couldn't fetch a cat picture right now. Try again later.")
+    try:
+        status, data = await fetch_backend_json(circuit_breakers["thecatapi"], CAT_API_URL)
+    except BackendUnavailable as e:
+        await interaction.followup.send(str(e))
+        return
+    if status == 200:
+        embed = discord.Embed(
+            title="Random Cat",
+            color=discord.Color.gold()
+        )
+        embed.set_image(url=data[0]['url'])
+        await interaction.followup.send(embed=embed)
+    else:
+        await interaction.followup.send("Couldn't fetch a cat picture right now. Try again later.")
 
 @tree.command(name="dog", description="Get a random dog picture")
 async def dog_command(interaction: discord.Interaction):
     await interaction.response.defer()
-    async with aiohttp.ClientSession() as session:
-        async with session.get('https://api.thedogapi.com/v1/images/search') as response:
-            if response.status == 200:
-                data = await response.json()
-                embed = discord.Embed(
-                    title="Random Dog",
-                    color=discord.Color.green()
-                )
-                embed.set_image(url=data[0]['url'])
-                await interaction.followup.send(embed=embed)
-            else:
-                await interaction.followup.send("Couldn't fetch a dog picture right now. Try again later.")
+    try:
+        status, data = await fetch_backend_json(circuit_breakers["thedogapi"], DOG_API_URL)
+    except BackendUnavailable as e:
+        await interaction.followup.send(str(e))
+        return
+    if status == 200:
+        embed = discord.Embed(
+            title="Random Dog",
+            color=discord.Color.green()
+        )
+        embed.set_image(url=data[0]['url'])
+        await interaction.followup.send(embed=embed)
+    else:
+        await interaction.followup.send("Couldn't fetch a dog picture right now. Try again later.")
 
 @tree.command(name="meme_category", description="Get a meme from a specific category")
 @app_commands.describe(category="Category of meme (programming, wholesome, dank, anime)")
@@ -969,159 +2819,232 @@ async def meme_category_command(interaction: discord.Interaction, category: str)
     # Default to dankmemes if category not found
     subreddit = subreddit_map.get(category.lower(), "dankmemes")
     
-    async with aiohttp.ClientSession() as session:
-        async with session.get(f'https://meme-api.com/gimme/{subreddit}') as response:
-            if response.status == 200:
-                data = await response.json()
-                embed = discord.Embed(
-                    title=data['title'],
-                    url=data['postLink'],
-                    color=discord.Color.random()
-                )
-                embed.set_image(url=data['url'])
-                embed.set_footer(text=f"👍 {data['ups']} | From r/{data['subreddit']}")
-                await interaction.followup.send(embed=embed)
-            else:
-                await interaction.followup.send(f"Couldn't fetch a {category} meme right now. Try again later.")
+    try:
+        status, data = await fetch_backend_json(circuit_breakers["meme-api"], f'{MEME_API_URL}/{subreddit}')
+    except BackendUnavailable as e:
+        await interaction.followup.send(str(e))
+        return
+    if status == 200:
+        embed = discord.Embed(
+            title=data['title'],
+            url=data['postLink'],
+            color=discord.Color.random()
+        )
+        embed.set_image(url=data['url'])
+        embed.set_footer(text=f"👍 {data['ups']} | From r/{data['subreddit']}")
+        await interaction.followup.send(embed=embed)
+    else:
+        await interaction.followup.send(f"Couldn't fetch a {category} meme right now. Try again later.")
 
-# Image generation command using Hugging Face's API
-@tree.command(name="imgen", description="Generate an image from your text prompt")
-@app_commands.describe(prompt="Describe the image you want to generate")
-async def imgen_command(interaction: discord.Interaction, prompt: str):
-    print(f"\n--- IMAGE GENERATION REQUEST ---")
-    print(f"User: {interaction.user.name} (ID: {interaction.user.id})")
-    print(f"Prompt: {prompt}")
+# Image generation using Hugging Face's API
+HUGGINGFACE_API_URL = "https://api-inference.huggingface.co/models/stabilityai/stable-diffusion-xl-base-1.0"
+
+# Raised when Hugging Face doesn't return an image; the message is shown to the user
+class ImageGenerationError(Exception):
+    pass
+
+# File signatures of the image formats Discord can display, mapped to a file extension
+image_signatures = [
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpg"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+]
+
+# Work out the image format from its first bytes; returns None for anything that isn't an image
+def detect_image_format(header):
+    for signature, extension in image_signatures:
+        if header.startswith(signature):
+            return extension
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+# Queue of /imgen jobs processed by a fixed number of background workers
+class ImageGenerationQueue:
+    def __init__(self, workers, max_jobs_per_user):
+        self.workers = max(1, workers)
+        self.max_jobs_per_user = max_jobs_per_user
+        self.queue = None
+        self.tasks = []
+        self.jobs_per_user = {}
+        self.active = 0
     
-    # Check if Hugging Face API key is set
-    if not HUGGINGFACE_API_KEY:
-        print("Error: Hugging Face API key not found")
-        await interaction.response.send_message(
-            "The image generation feature is not available. Please add a Hugging Face API key to the .env file.",
-            ephemeral=True
-        )
-        return
+    def start(self):
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+            self.tasks = [asyncio.create_task(self.worker(), name="imgen-worker") for _ in range(self.workers)]
     
-    # Defer response since image generation can take time
-    await interaction.response.defer(thinking=True)
-    print("Response deferred - bot is 'thinking'")
+    def is_user_full(self, user_id):
+        return self.jobs_per_user.get(user_id, 0) >= self.max_jobs_per_user
     
-    try:
-        # Print debug info
-        print(f"Starting image generation process...")
-        print(f"API Key being used: {HUGGINGFACE_API_KEY[:4]}...{HUGGINGFACE_API_KEY[-4:]}")
-        
-        # Using Stable Diffusion XL via Hugging Face API
-        API_URL = "https://api-inference.huggingface.co/models/stabilityai/stable-diffusion-xl-base-1.0"
-        headers = {
-            "Authorization": f"Bearer {HUGGINGFACE_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        
-        # Prepare the payload
-        payload = {"inputs": prompt}
+    # Add a job for the user; returns how many jobs are waiting ahead of it, or None if the user already has too many queued
+    def submit(self, interaction, prompt):
+        user_id = interaction.user.id
+        if self.is_user_full(user_id):
+            return None
         
-        print(f"Making API request to: {API_URL}")
-        print(f"Headers: {headers}")
-        print(f"Payload: {payload}")
-        
-        # Make the API request with timeout
-        print("Sending request to Hugging Face API...")
-        response = requests.post(API_URL, headers=headers, json=payload, timeout=90)
-        
-        print(f"Response received!")
-        print(f"Status code: {response.status_code}")
-        print(f"Headers: {dict(response.headers)}")
-        
-        # Check if the response is successful
-        if response.status_code == 200:
-            print(f"Successful response (200)")
-            print(f"Content type: {response.headers.get('Content-Type', 'unknown')}")
-            print(f"Content length: {len(response.content)} bytes")
-            
-            # Check if the response is actually an image
-            if response.headers.get('Content-Type', '').startswith('image/'):
-                print("Response contains image data, saving...")
-                # Save the image temporarily
-                image_filename = f"generated_image_{interaction.id}.png"
-                with open(image_filename, "wb") as image_file:
-                    image_file.write(response.content)
-                print(f"Image saved to {image_filename}")
-                
-                # Create a Discord file object
-                file = discord.File(image_filename, filename="generated_image.png")
+        self.jobs_per_user[user_id] = self.jobs_per_user.get(user_id, 0) + 1
+        waiting = self.queue.qsize() + max(0, self.active - self.workers + 1)
+        self.queue.put_nowait((interaction, prompt))
+        return waiting
+    
+    async def worker(self):
+        while True:
+            interaction, prompt = await self.queue.get()
+            self.active += 1
+            try:
+                await generate_image_job(interaction, prompt)
+            except Exception as e:
+                imgen_log.exception("Unexpected error in image generation worker: %s", e)
+            finally:
+                self.active -= 1
+                remaining = self.jobs_per_user.get(interaction.user.id, 1) - 1
+                if remaining > 0:
+                    self.jobs_per_user[interaction.user.id] = remaining
+                else:
+                    self.jobs_per_user.pop(interaction.user.id, None)
+                self.queue.task_done()
+    
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+image_queue = ImageGenerationQueue(IMGEN_WORKERS, IMGEN_MAX_JOBS_PER_USER)
+
+# Show job progress in place of the deferred "thinking" response
+async def update_imgen_progress(interaction, content):
+    try:
+        await interaction.edit_original_response(content=content)
+    except Exception as e:
+        imgen_log.error("Error updating image generation progress: %s", e)
+
+# Read an image response into memory, stopping early if it is larger than IMGEN_MAX_BYTES
+async def read_image_response(response):
+    if IMGEN_MAX_BYTES and response.content_length and response.content_length > IMGEN_MAX_BYTES:
+        raise ImageGenerationError(f"The generated image is too large ({response.content_length} bytes).")
+    
+    buffer = io.BytesIO()
+    async for chunk in response.content.iter_chunked(64 * 1024):
+        buffer.write(chunk)
+        if IMGEN_MAX_BYTES and buffer.tell() > IMGEN_MAX_BYTES:
+            raise ImageGenerationError(f"The generated image is larger than {IMGEN_MAX_BYTES} bytes.")
+    buffer.seek(0)
+    return buffer
+
+# Request an image from Hugging Face, retrying while the model warms up; returns (content_type, BytesIO)
+async def request_image(interaction, prompt):
+    headers = {
+        "Authorization": f"Bearer {HUGGINGFACE_API_KEY}",
+        "Content-Type": "application/json"
+    }
+    payload = {"inputs": prompt}
+    timeout = aiohttp.ClientTimeout(total=IMGEN_TIMEOUT)
+    breaker = circuit_breakers["huggingface"]
+    
+    for attempt in range(IMGEN_MAX_RETRIES + 1):
+        imgen_log.debug("Sending request to Hugging Face API (attempt %d)", attempt + 1)
+        with breaker.guard() as call:
+            async with client.http_session.post(HUGGINGFACE_API_URL, headers=headers, json=payload, timeout=timeout) as response:
+                content_type = response.headers.get('Content-Type', '')
                 
-                # Create an embed
-                embed = discord.Embed(
-                    title="Generated Image",
-                    description=f"**Prompt:** {prompt}",
-                    color=discord.Color.purple()
-                )
-                embed.set_image(url="attachment://generated_image.png")
-                embed.set_footer(text=f"Generated by Stable Diffusion XL • Requested by {interaction.user.display_name}", 
-                                icon_url=interaction.user.display_avatar.url)
+                if response.status == 200 and content_type.startswith('image/'):
+                    return content_type, await read_image_response(response)
                 
-                # Send the embed with the image
-                print("Sending image to Discord...")
-                await interaction.followup.send(embed=embed, file=file)
-                print("Image sent successfully!")
+                error_data = {}
+                if content_type.startswith('application/json'):
+                    try:
+                        error_data = await response.json()
+                    except Exception as json_error:
+                        imgen_log.warning("Error parsing JSON response: %s", json_error)
                 
-                # Clean up the temporary file
-                try:
-                    os.remove(image_filename)
-                    print(f"Temporary file {image_filename} removed")
-                except Exception as cleanup_error:
-                    print(f"Error cleaning up temporary file: {cleanup_error}")
-            
-            # Handle case where response is JSON (possibly an error)
-            elif response.headers.get('Content-Type', '').startswith('application/json'):
-                print("Response contains JSON data instead of an image")
+                # A model that is still loading is normal; being rate limited or down is not
+                warming_up = isinstance(error_data, dict) and "estimated_time" in error_data
+                if not warming_up and (response.status == 429 or response.status >= 500):
+                    call.fail()
+        
+        # The model is still loading (or the service is busy) - wait and try again
+        if (warming_up or response.status in (429, 503)) and attempt < IMGEN_MAX_RETRIES:
+            delay = IMGEN_RETRY_BASE_DELAY * (2 ** attempt)
+            if warming_up:
                 try:
-                    error_data = response.json()
-                    print(f"JSON content: {error_data}")
-                    
-                    error_message = "The API returned JSON data instead of an image."
-                    if "error" in error_data:
-                        error_message = f"API Error: {error_data['error']}"
-                    elif "estimated_time" in error_data:
-                        wait_time = error_data.get('estimated_time', 'unknown')
-                        error_message = f"Model is currently loading (wait ~{wait_time} seconds). Please try again soon."
-                    
-                    print(f"Sending error message to user: {error_message}")
-                    await interaction.followup.send(f"Failed to generate the image. {error_message}", ephemeral=True)
-                except Exception as json_error:
-                    print(f"Error parsing JSON response: {json_error}")
-                    print(f"Raw response content: {response.content[:500]}...")
-                    await interaction.followup.send("Failed to generate the image. The API returned an unexpected response format.", ephemeral=True)
-            else:
-                print(f"Unexpected content type in response: {response.headers.get('Content-Type', 'unknown')}")
-                print(f"First 500 bytes of response: {response.content[:500]}...")
-                await interaction.followup.send("Failed to generate the image. The API returned an unexpected content type.", ephemeral=True)
-            
-        else:
-            # Handle API errors
-            print(f"Error response received: {response.status_code}")
-            error_message = f"Error: API returned status code {response.status_code}"
-            try:
-                error_data = response.json()
-                print(f"Error response JSON: {error_data}")
-                if "error" in error_data:
-                    error_message = f"API Error: {error_data['error']}"
-            except Exception as parse_error:
-                print(f"Error parsing error response: {parse_error}")
-                print(f"Raw error response: {response.text[:500]}")
+                    delay = max(delay, float(error_data["estimated_time"]))
+                except (TypeError, ValueError):
+                    pass
+            delay = min(delay, IMGEN_RETRY_MAX_DELAY)
             
-            print(f"Final error message: {error_message}")
-            await interaction.followup.send(f"Failed to generate the image. {error_message}", ephemeral=True)
-            
-    except requests.exceptions.Timeout:
-        print("Request timed out after 90 seconds")
-        await interaction.followup.send("The image generation request timed out. The service might be overloaded. Please try again later.", ephemeral=True)
+            reason = "The model is warming up" if warming_up else "The image service is busy"
+            await update_imgen_progress(
+                interaction,
+                f"⏳ {reason}, retrying in ~{delay:.0f} seconds (attempt {attempt + 2}/{IMGEN_MAX_RETRIES + 1})..."
+            )
+            await asyncio.sleep(delay)
+            await update_imgen_progress(interaction, "🎨 Generating your image...")
+            continue
+        
+        if response.status == 200 and not error_data:
+            raise ImageGenerationError("The API returned an unexpected content type.")
+        
+        error_message = f"Error: API returned status code {response.status}"
+        if isinstance(error_data, dict) and "error" in error_data:
+            error_message = f"API Error: {error_data['error']}"
+        elif warming_up:
+            error_message = f"Model is currently loading (wait ~{error_data.get('estimated_time', 'unknown')} seconds). Please try again soon."
+        elif response.status == 200:
+            error_message = "The API returned JSON data instead of an image."
+        raise ImageGenerationError(error_message)
+
+# Run one queued /imgen job and deliver the result by editing the deferred response
+async def generate_image_job(interaction, prompt):
+    started = time.perf_counter()
+    fields = {"user_id": interaction.user.id, "prompt_chars": len(prompt)}
+    imgen_log.info("Image generation started", extra=fields)
+    imgen_log.debug("Image generation prompt: %s", prompt, extra=fields)
+    
+    await update_imgen_progress(interaction, "🎨 Generating your image...")
+    
+    try:
+        content_type, image_buffer = await request_image(interaction, prompt)
+        fields["image_bytes"] = image_buffer.getbuffer().nbytes
+        
+        # Make sure the bytes are an image Discord can show, and name the file after its real format
+        extension = detect_image_format(image_buffer.getbuffer()[:16].tobytes())
+        if extension is None:
+            if IMGEN_VERIFY_IMAGES:
+                raise ImageGenerationError(f"The API returned data that isn't a valid image ({content_type}).")
+            extension = "png"
+        image_filename = f"generated_image.{extension}"
+        
+        # Hand the in-memory image straight to Discord
+        file = discord.File(image_buffer, filename=image_filename)
+        
+        # Create an embed
+        embed = discord.Embed(
+            title="Generated Image",
+            description=f"**Prompt:** {prompt}",
+            color=discord.Color.purple()
+        )
+        embed.set_image(url=f"attachment://{image_filename}")
+        embed.set_footer(text=f"Generated by Stable Diffusion XL • Requested by {interaction.user.display_name}", 
+                        icon_url=interaction.user.display_avatar.url)
+        
+        # Replace the progress message with the image
+        await interaction.edit_original_response(content=None, embed=embed, attachments=[file])
+        imgen_log.info("Image sent", extra=dict(fields, seconds=round(time.perf_counter() - started, 3)))
+    
+    except ImageGenerationError as e:
+        imgen_log.warning("Image generation failed: %s", e, extra=fields)
+        await update_imgen_progress(interaction, f"Failed to generate the image. {e}")
+    except BackendUnavailable as e:
+        imgen_log.warning("Skipped image generation: %s", e, extra=fields)
+        await update_imgen_progress(interaction, str(e))
+    except asyncio.TimeoutError:
+        imgen_log.warning("Request timed out after %s seconds", IMGEN_TIMEOUT, extra=fields)
+        await update_imgen_progress(interaction, "The image generation request timed out. The service might be overloaded. Please try again later.")
     except Exception as e:
-        print(f"Unexpected exception during image generation:")
-        print(f"Error type: {type(e).__name__}")
-        print(f"Error message: {str(e)}")
-        print("Full traceback:")
-        traceback.print_exc()
+        imgen_log.exception("Unexpected %s during image generation: %s", type(e).__name__, e, extra=fields)
         
         # Provide more helpful error messages based on common issues
         user_message = "Error generating image: "
@@ -1137,10 +3060,229 @@ async def imgen_command(interaction: discord.Interaction, prompt: str):
         else:
             user_message += f"{str(e)}"
         
-        print(f"Sending error message to user: {user_message}")
-        await interaction.followup.send(user_message, ephemeral=True)
+        await update_imgen_progress(interaction, user_message)
+
+@tree.command(name="imgen", description="Generate an image from your text prompt")
+@app_commands.describe(prompt="Describe the image you want to generate")
+async def imgen_command(interaction: discord.Interaction, prompt: str):
+    # Check if Hugging Face API key is set
+    if not HUGGINGFACE_API_KEY:
+        imgen_log.error("Hugging Face API key not found")
+        await interaction.response.send_message(
+            "The image generation feature is not available. Please add a Hugging Face API key to the .env file.",
+            ephemeral=True
+        )
+        return
+    
+    # Don't queue jobs while Hugging Face is known to be failing
+    try:
+        circuit_breakers["huggingface"].check()
+    except BackendUnavailable as e:
+        await interaction.response.send_message(str(e), ephemeral=True)
+        return
+    
+    # Limit how many images one user can have waiting
+    if image_queue.is_user_full(interaction.user.id):
+        await interaction.response.send_message(
+            f"You already have {IMGEN_MAX_JOBS_PER_USER} images being generated. Please wait for them to finish.",
+            ephemeral=True
+        )
+        return
+    
+    # Defer response since image generation can take time
+    await interaction.response.defer(thinking=True)
+    
+    waiting = image_queue.submit(interaction, prompt)
+    if waiting is None:
+        await update_imgen_progress(
+            interaction,
+            f"You already have {IMGEN_MAX_JOBS_PER_USER} images being generated. Please wait for them to finish."
+        )
+    elif waiting > 0:
+        await update_imgen_progress(interaction, f"🕒 Your image is queued ({waiting} ahead of you).")
+
+# Weather lookups from OpenWeatherMap with a TTL cache keyed by normalized city name
+OPENWEATHER_API_URL = "https://api.openweathermap.org/data/2.5/weather"
+
+class WeatherClient:
+    def __init__(self, ttl, not_found_ttl, max_entries):
+        self.ttl = ttl
+        self.not_found_ttl = not_found_ttl
+        self.max_entries = max_entries
+        self.cache = OrderedDict()  # city -> (expires_at, status, data)
+        self.in_flight = {}
+        self.hits = 0
+        self.misses = 0
+    
+    @staticmethod
+    def normalize(city):
+        return " ".join(city.lower().split())
+    
+    # Current weather for the city as (status, data); successful and 404 responses are cached
+    async def fetch(self, city):
+        key = self.normalize(city)
+        cached = self.cache.get(key)
+        if cached is not None and cached[0] > time.time():
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return cached[1], cached[2]
+        
+        self.misses += 1
+        # Share one request between concurrent lookups of the same city
+        if key not in self.in_flight:
+            self.in_flight[key] = asyncio.ensure_future(self._request(key, city))
+        return await asyncio.shield(self.in_flight[key])
+    
+    async def _request(self, key, city):
+        try:
+            return await self._fetch_and_store(key, city)
+        finally:
+            self.in_flight.pop(key, None)
+    
+    async def _fetch_and_store(self, key, city):
+        params = {
+            "q": city,
+            "appid": OPENWEATHER_API_KEY,
+            "units": "metric"  # Use metric for Celsius
+        }
+        with circuit_breakers["openweathermap"].guard() as call:
+            async with client.http_session.get(OPENWEATHER_API_URL, params=params, timeout=aiohttp.ClientTimeout(total=WEATHER_TIMEOUT)) as response:
+                status = response.status
+                if status == 429 or status >= 500:
+                    call.fail()
+                try:
+                    data = await response.json(content_type=None)
+                except Exception:
+                    data = {"message": "Unknown error"}
+        
+        now = time.time()
+        if status == 200 and isinstance(data, dict):
+            # OpenWeatherMap refreshes roughly every 10 minutes from the "dt" time, so expire with the data
+            expires_at = now + self.ttl
+            if isinstance(data.get("dt"), (int, float)):
+                expires_at = min(expires_at, max(data["dt"] + self.ttl, now + 60))
+            self.store(key, expires_at, status, data)
+        elif status == 404:
+            self.store(key, now + self.not_found_ttl, status, data)
+        
+        return status, data
     
-    print("--- IMAGE GENERATION REQUEST COMPLETED ---\n")
+    def store(self, key, expires_at, status, data):
+        self.cache[key] = (expires_at, status, data)
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
+
+weather_client = WeatherClient(WEATHER_CACHE_TTL, WEATHER_NOT_FOUND_TTL, WEATHER_CACHE_SIZE)
+
+# Metrics read from the caches, circuit breakers and queues when metrics are rendered
+def cache_samples():
+    for name, cache in (("conversation", conversation_cache), ("weather", weather_client)):
+        yield (name, "hit"), cache.hits
+        yield (name, "miss"), cache.misses
+    yield ("tlme", "hit"), tlme_cache.hits
+    yield ("tlme", "similar_hit"), tlme_cache.similar_hits
+    yield ("tlme", "miss"), tlme_cache.misses
+
+breaker_states = {"closed": 0, "half-open": 1, "open": 2}
+
+def breaker_samples(read):
+    def samples():
+        for name, breaker in circuit_breakers.items():
+            yield from read(name, breaker.snapshot())
+    return samples
+
+def breaker_call_counts(name, snapshot):
+    yield (name, "success"), snapshot["calls"] - snapshot["failures"]
+    yield (name, "failure"), snapshot["failures"]
+    yield (name, "rejected"), snapshot["rejected"]
+
+def breaker_latency(name, snapshot):
+    # Nothing to report until the backend has answered at least once
+    if snapshot["average_latency"] is not None:
+        yield (name,), snapshot["average_latency"]
+
+def admission_samples():
+    usage = admission.snapshot()
+    yield ("admitted",), usage["admitted"]
+    for scope, count in usage["rejected"].items():
+        yield (f"rejected_{scope}",), count
+
+def admission_bucket_samples():
+    usage = admission.snapshot()
+    yield ("tokens",), usage["global_tokens"]
+    yield ("capacity",), usage["global_capacity"]
+
+def admission_tracked_samples():
+    usage = admission.snapshot()
+    yield ("user",), usage["tracked_users"]
+    yield ("guild",), usage["tracked_guilds"]
+
+def image_queue_samples():
+    yield ("waiting",), image_queue.queue.qsize() if image_queue.queue is not None else 0
+    yield ("active",), image_queue.active
+
+metrics.collected("bot_cache_requests_total", "Cache lookups by cache and result", ("cache", "result"), cache_samples, kind="counter")
+metrics.collected(
+    "circuit_breaker_state", "Circuit breaker state (0 closed, 1 half-open, 2 open)", ("backend",),
+    breaker_samples(lambda name, snapshot: [((name,), breaker_states[snapshot["state"]])])
+)
+metrics.collected(
+    "circuit_breaker_calls_total", "Backend calls by circuit breaker outcome", ("backend", "result"),
+    breaker_samples(breaker_call_counts), kind="counter"
+)
+metrics.collected(
+    "circuit_breaker_opened_total", "Times each circuit breaker has opened", ("backend",),
+    breaker_samples(lambda name, snapshot: [((name,), snapshot["opened"])]), kind="counter"
+)
+metrics.collected(
+    "circuit_breaker_error_rate", "Share of recent backend calls that failed", ("backend",),
+    breaker_samples(lambda name, snapshot: [((name,), snapshot["error_rate"])])
+)
+metrics.collected(
+    "circuit_breaker_average_latency_seconds", "Moving average of backend response time seen by the breaker", ("backend",),
+    breaker_samples(breaker_latency)
+)
+metrics.collected("bot_ai_admission_total", "AI requests admitted or rejected by the rate limits", ("result",), admission_samples, kind="counter")
+metrics.collected("bot_ai_admission_global_bucket", "Fill and capacity of the global AI rate limit bucket", ("measure",), admission_bucket_samples)
+metrics.collected("bot_ai_admission_tracked_buckets", "Users and servers with a rate limit bucket", ("scope",), admission_tracked_samples)
+metrics.collected("imgen_queue_jobs", "/imgen jobs waiting or being generated", ("state",), image_queue_samples)
+# Gateway latency and guild count for each shard this process runs
+def shard_latency_samples():
+    latencies = client.latencies if SHARDED else [(client.shard_id or 0, client.latency)]
+    for shard_id, latency in latencies:
+        if math.isfinite(latency):
+            yield (shard_id,), latency
+
+def shard_guild_samples():
+    counts = {}
+    for guild in client.guilds:
+        counts[guild.shard_id] = counts.get(guild.shard_id, 0) + 1
+    for shard_id, count in counts.items():
+        yield (shard_id,), count
+
+metrics.collected("discord_shard_latency_seconds", "Gateway heartbeat latency by shard", ("shard",), shard_latency_samples)
+metrics.collected("discord_shard_guilds", "Servers handled by each shard", ("shard",), shard_guild_samples)
+metrics.collected("bot_ai_working", "Whether the last Gemini health check passed", (), lambda: [((), int(ai_working))])
+
+async def metrics_handler(request):
+    return web.Response(body=metrics.render().encode('utf-8'), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+# Serve /metrics on METRICS_HOST:METRICS_PORT; returns the runner to clean up on shutdown
+async def start_metrics_server():
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    metrics_log.info("Serving metrics on http://%s:%d/metrics", METRICS_HOST, METRICS_PORT)
+    return runner
+
+def write_metrics_dump():
+    temp_path = f"{METRICS_DUMP_PATH}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as file:
+        file.write(metrics.render())
+    os.replace(temp_path, METRICS_DUMP_PATH)
 
 # Weather command
 @tree.command(name="weather", description="Get current weather information for a city")
@@ -1158,23 +3300,13 @@ async def weather_command(interaction: discord.Interaction, city: str):
     await interaction.response.defer(thinking=True)
     
     try:
-        print(f"Fetching weather for city: {city}")
-        
-        # Call the OpenWeatherMap API to get current weather
-        base_url = "https://api.openweathermap.org/data/2.5/weather"
-        params = {
-            "q": city,
-            "appid": OPENWEATHER_API_KEY,
-            "units": "metric"  # Use metric for Celsius
-        }
+        weather_log.debug("Fetching weather for city: %s", city)
         
-        # Make the API request
-        response = requests.get(base_url, params=params, timeout=15)
+        # Get the current weather from OpenWeatherMap (or the cache)
+        status, weather_data = await weather_client.fetch(city)
         
         # Check if the response is successful
-        if response.status_code == 200:
-            # Parse the weather data
-            weather_data = response.json()
+        if status == 200:
             
             # Extract the main weather information
             weather_main = weather_data["weather"][0]["main"]
@@ -1230,18 +3362,19 @@ async def weather_command(interaction: discord.Interaction, city: str):
             
             # Send the embed
             await interaction.followup.send(embed=embed)
-            print(f"Weather data sent successfully for {city_name}, {country}")
+            weather_log.debug("Weather data sent successfully for %s, %s", city_name, country)
             
-        elif response.status_code == 404:
+        elif status == 404:
             await interaction.followup.send(f"City '{city}' not found. Please check the spelling and try again.", ephemeral=True)
         else:
-            error_data = response.json() if response.content else {"message": "Unknown error"}
-            error_message = error_data.get("message", "Unknown error")
+            error_message = weather_data.get("message", "Unknown error") if isinstance(weather_data, dict) else "Unknown error"
             await interaction.followup.send(f"Error fetching weather data: {error_message}", ephemeral=True)
             
+    except BackendUnavailable as e:
+        weather_log.warning("Skipped weather lookup: %s", e)
+        await interaction.followup.send(str(e), ephemeral=True)
     except Exception as e:
-        print(f"Error in weather command: {str(e)}")
-        traceback.print_exc()
+        weather_log.exception("Error in weather command: %s", e)
         await interaction.followup.send(f"Error fetching weather data: {str(e)}", ephemeral=True)
 
 # User information command
@@ -1490,12 +3623,12 @@ class TicTacToeView(discord.ui.View):
                         view=new_game_view
                     )
                 except Exception as e:
-                    print(f"Error sending timeout results: {e}")
+                    games_log.error("Error sending timeout results: %s", e)
         except asyncio.CancelledError:
             # Timer was cancelled because a move was made
             pass
         except Exception as e:
-            print(f"Error in turn timer: {e}")
+            games_log.error("Error in turn timer: %s", e)
     
     def check_winner(self):
         # Check rows
@@ -1668,22 +3801,68 @@ async def tictactoe_command(interaction: discord.Interaction, opponent: discord.
     view.turn_timer_task = asyncio.create_task(view.turn_timer(interaction))
 
 # Start the bot
+# Run SHARD_PROCESSES copies of the bot, each with a contiguous range of the SHARD_COUNT shards, and stop them
+# all when one exits or on Ctrl+C. Each process gets its own metrics port and dump file.
+def run_shard_processes():
+    if not SHARD_COUNT.isdigit():
+        log.error("SHARD_PROCESSES needs SHARD_COUNT set to a number of shards")
+        return
+    shard_count = int(SHARD_COUNT)
+    
+    processes = []
+    for index in range(SHARD_PROCESSES):
+        shard_ids = range(index * shard_count // SHARD_PROCESSES, (index + 1) * shard_count // SHARD_PROCESSES)
+        if not shard_ids:
+            continue
+        env = dict(
+            os.environ,
+            SHARD_COUNT=str(shard_count),
+            SHARD_IDS=f"{shard_ids[0]}-{shard_ids[-1]}",
+            SHARD_PROCESSES="1",
+            CONVERSATION_SHARED_STORE="true",
+            SYNC_COMMANDS="true" if index == 0 else "false",
+            METRICS_PORT=str(METRICS_PORT + index if METRICS_PORT else 0),
+            METRICS_DUMP_PATH=f"{METRICS_DUMP_PATH}.{index}",
+        )
+        log.info("Starting bot process %d for shards %d-%d of %d", index, shard_ids[0], shard_ids[-1], shard_count)
+        processes.append(subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env))
+    
+    try:
+        while all(process.poll() is None for process in processes):
+            time.sleep(1)
+        log.error("A bot process exited; stopping the others")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # SIGTERM makes each bot close cleanly, flushing its conversation logs and metrics; only
+        # processes that are still running after SHARD_SHUTDOWN_TIMEOUT are killed
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+        deadline = time.monotonic() + SHARD_SHUTDOWN_TIMEOUT
+        for process in processes:
+            try:
+                process.wait(timeout=max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                log.warning("Bot process %d didn't stop within %.0f seconds; killing it", process.pid, SHARD_SHUTDOWN_TIMEOUT)
+                process.kill()
+                process.wait()
+
 if __name__ == "__main__":
     if TOKEN is None or TOKEN == "your_bot_token_here":
-        print("Error: No valid Discord token found. Please set the DISCORD_TOKEN environment variable in the .env file.")
-        print("You need to get a real Discord bot token from the Discord Developer Portal.")
+        log.error(
+            "No valid Discord token found. Please set the DISCORD_TOKEN environment variable in the .env file. "
+            "You need to get a real Discord bot token from the Discord Developer Portal."
+        )
+    elif SHARD_PROCESSES > 1:
+        run_shard_processes()
     else:
         try:
-            print("\n=== STARTING BOT ===")
-            print(f"Bot will connect to Discord with token: {TOKEN[:5]}...{TOKEN[-5:]}")
-            print("Running client.run()...")
-            client.run(TOKEN)
+            log.info("Starting bot")
+            # discord.py logs through the handler set up by setup_logging
+            client.run(TOKEN, log_handler=None)
         except discord.errors.LoginFailure as e:
-            print(f"Error: Failed to login to Discord: {e}")
-            print("Check if your Discord token is correct in the .env file.")
+            log.error("Failed to login to Discord: %s. Check if your Discord token is correct in the .env file.", e)
         except Exception as e:
-            print(f"Unexpected error starting bot: {e}")
-            print("Full traceback:")
-            traceback.print_exc()
-            print("\nPlease fix the issues above and try again.") 
+            log.exception("Unexpected error starting bot: %s. Please fix the issues above and try again.", e) 
             
\ No newline at end of file
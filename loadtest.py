@@ -0,0 +1,493 @@
+# Offline load test: drives synthetic chat messages and slash commands through the real handlers in bot.py,
+# with local stand-ins for Discord, Gemini, Hugging Face, OpenWeatherMap and the meme/cat/dog APIs.
+# Reports throughput, p50/p95/p99 latency per scenario and event loop lag. Needs no network access or keys.
+#
+# Usage: python loadtest.py [--requests 500] [--concurrency 50] [--gemini-latency 0.5] [--http-error-rate 0.05] ...
+#        python loadtest.py --help
+import argparse
+import asyncio
+import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+from aiohttp import web
+
+# Share of requests per scenario
+default_mix = {"dm": 25, "airi": 20, "prefix": 15, "tlme": 15, "weather": 10, "meme": 10, "imgen": 5}
+
+# A tiny valid PNG, returned by the fake Hugging Face API
+png_image = (
+    b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x06\x00\x00\x00\x1f\x15\xc4\x89"
+    b"\x00\x00\x00\rIDATx\x9cc\xf8\xff\xff?\x00\x05\xfe\x02\xfe\xa75\x81\x84\x00\x00\x00\x00IEND\xaeB`\x82"
+)
+
+base_questions = [
+    "what is the capital of france", "explain recursion like i'm five", "how do black holes form",
+    "give me a pasta recipe", "what's the difference between tcp and udp", "why is the sky blue",
+    "write a haiku about mondays", "how does compound interest work", "what is a monad",
+    "recommend a sci-fi book",
+]
+
+# Numbered variants so /tlme answers aren't all served from its cache
+def make_questions(distinct):
+    return [f"{base_questions[i % len(base_questions)]} (variant {i})" for i in range(max(1, distinct))]
+
+cities = ["London", "Tokyo", "New York", "Paris", "Berlin", "Sydney", "Toronto", "Mumbai"]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline load test for bot.py")
+    parser.add_argument("--requests", type=int, default=500, help="Total messages and commands to send")
+    parser.add_argument("--concurrency", type=int, default=50, help="Requests in flight at once")
+    parser.add_argument("--users", type=int, default=200, help="Distinct simulated users")
+    parser.add_argument("--mix", default=",".join(f"{name}={weight}" for name, weight in default_mix.items()),
+                        help="Scenario weights, e.g. dm=50,tlme=50")
+    parser.add_argument("--gemini-latency", type=float, default=0.5, help="Seconds per fake Gemini reply")
+    parser.add_argument("--gemini-error-rate", type=float, default=0.0, help="Share of Gemini calls that fail")
+    parser.add_argument("--stream-chunks", type=int, default=5, help="Chunks per streamed Gemini reply")
+    parser.add_argument("--reply-chars", type=int, default=600, help="Length of fake Gemini replies")
+    parser.add_argument("--http-latency", type=float, default=0.05, help="Seconds per fake weather/meme/cat/dog request")
+    parser.add_argument("--http-error-rate", type=float, default=0.0, help="Share of fake HTTP requests answered with 503")
+    parser.add_argument("--imgen-latency", type=float, default=2.0, help="Seconds per fake Hugging Face image")
+    parser.add_argument("--discord-latency", type=float, default=0.05, help="Seconds per fake Discord API call")
+    parser.add_argument("--coalesce-window", type=float, default=0.0, help="COALESCE_WINDOW for the run")
+    parser.add_argument("--no-stream", action="store_true", help="Run with STREAM_RESPONSES=false")
+    parser.add_argument("--timeout", type=float, default=120, help="Seconds to wait for any one request")
+    parser.add_argument("--distinct-questions", type=int, default=50, help="Different questions asked (repeats hit the /tlme cache)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--metrics", help="Write the bot's metrics to this file after the run")
+    return parser.parse_args()
+
+# bot.py reads its settings at import time, so they are set before importing it
+def configure_environment(args, data_dir):
+    os.environ.update({
+        "DISCORD_TOKEN": "loadtest-discord-token",
+        "GEMINI_API_KEY": "loadtest-gemini-key",
+        "HUGGINGFACE_API_KEY": "loadtest-huggingface-key",
+        "OPENWEATHER_API_KEY": "loadtest-openweather-key",
+        "CONVERSATION_DB_PATH": os.path.join(data_dir, "conversations.db"),
+        "COALESCE_WINDOW": str(args.coalesce_window),
+        "STREAM_RESPONSES": "false" if args.no_stream else "true",
+        "STREAM_EDIT_INTERVAL": "0.2",
+        "AI_USER_RATE": "100000", "AI_USER_BURST": "100000",
+        "AI_GUILD_RATE": "100000", "AI_GUILD_BURST": "100000",
+        "AI_GLOBAL_RATE": "100000", "AI_GLOBAL_BURST": "100000",
+        "IMGEN_MAX_JOBS_PER_USER": "1000",
+        "IMGEN_RETRY_BASE_DELAY": "0.1",
+        "METRICS_PORT": "0",
+        "METRICS_DUMP_INTERVAL": "0",
+        "WATCHDOG_REPORT_INTERVAL": "0",
+    })
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ.setdefault("LOG_FORMAT", "text")
+
+# Stand-in for the Gemini model; runs on the engine's thread pool like the real client
+class FakeGeminiModel:
+    def __init__(self, latency, error_rate, chunks, reply_chars):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.chunks = max(1, chunks)
+        self.reply = ("Sure thing! Here's what I think. " * (reply_chars // 33 + 1))[:reply_chars]
+
+    def generate_content(self, prompt, stream=False):
+        if random.random() < self.error_rate:
+            time.sleep(self.latency / 2)
+            raise RuntimeError("503 The model is overloaded (injected error)")
+        if not stream:
+            time.sleep(self.latency)
+            return SimpleNamespace(text=self.reply)
+        return self._stream()
+
+    def _stream(self):
+        size = len(self.reply) // self.chunks + 1
+        for start in range(0, len(self.reply), size):
+            time.sleep(self.latency / self.chunks)
+            yield SimpleNamespace(text=self.reply[start:start + size])
+
+    def count_tokens(self, text):
+        return SimpleNamespace(total_tokens=len(text) // 4)
+
+# Local HTTP server standing in for Hugging Face, OpenWeatherMap, meme-api and the cat/dog APIs
+async def start_fake_backends(args):
+    async def delay(latency):
+        await asyncio.sleep(latency * random.uniform(0.5, 1.5))
+        return random.random() < args.http_error_rate
+
+    async def huggingface(request):
+        await request.read()
+        if await delay(args.imgen_latency):
+            return web.json_response({"error": "Service Unavailable (injected error)"}, status=503)
+        return web.Response(body=png_image, content_type="image/png")
+
+    async def weather(request):
+        if await delay(args.http_latency):
+            return web.json_response({"message": "injected error"}, status=503)
+        return web.json_response({
+            "weather": [{"main": "Clouds", "description": "scattered clouds", "icon": "03d"}],
+            "main": {"temp": 18.5, "feels_like": 17.9, "humidity": 62, "pressure": 1014},
+            "wind": {"speed": 4.1},
+            "sys": {"country": "XX"},
+            "visibility": 10000,
+            "name": request.query.get("q", "Nowhere"),
+            "dt": int(time.time()),
+        })
+
+    async def meme(request):
+        if await delay(args.http_latency):
+            return web.json_response({"message": "injected error"}, status=503)
+        subreddit = request.match_info.get("subreddit", "dankmemes")
+        return web.json_response({
+            "title": "A meme", "postLink": "https://example.invalid/post", "url": "https://example.invalid/meme.png",
+            "ups": 42, "subreddit": subreddit,
+        })
+
+    async def animal(request):
+        if await delay(args.http_latency):
+            return web.json_response({"message": "injected error"}, status=503)
+        return web.json_response([{"url": "https://example.invalid/animal.jpg"}])
+
+    app = web.Application()
+    app.router.add_post("/huggingface", huggingface)
+    app.router.add_get("/weather", weather)
+    app.router.add_get("/gimme", meme)
+    app.router.add_get("/gimme/{subreddit}", meme)
+    app.router.add_get("/cat", animal)
+    app.router.add_get("/dog", animal)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, f"http://{host}:{port}"
+
+# --- Discord stand-ins: just enough of messages, channels and interactions for the handlers ---
+
+class FakeDiscordApi:
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+
+    async def call(self):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.name = f"user{user_id}"
+        self.display_name = self.name
+        self.bot = False
+        self.display_avatar = SimpleNamespace(url="https://example.invalid/avatar.png")
+
+class FakeTyping:
+    def __init__(self, api):
+        self.api = api
+
+    async def __aenter__(self):
+        await self.api.call()
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+class FakeSentMessage:
+    def __init__(self, api, channel, content=None, embed=None):
+        self.api = api
+        self.channel = channel
+        self.content = content
+        self.embed = embed
+        self.id = random.getrandbits(48)
+
+    async def edit(self, content=None, embed=None, attachments=None, **kwargs):
+        await self.api.call()
+        if content is not None:
+            self.content = content
+        if embed is not None:
+            self.embed = embed
+        return self
+
+    async def delete(self):
+        await self.api.call()
+
+class FakeChannel:
+    def __init__(self, api, channel_id, name):
+        self.api = api
+        self.id = channel_id
+        self.name = name
+
+    def typing(self):
+        return FakeTyping(self.api)
+
+    async def send(self, content=None, file=None, embed=None, **kwargs):
+        await self.api.call()
+        return FakeSentMessage(self.api, self, content, embed)
+
+def make_dm_channel_class(discord):
+    # classify_message recognizes DMs with isinstance(channel, discord.DMChannel)
+    class FakeDMChannel(FakeChannel, discord.DMChannel):
+        def __init__(self, api, channel_id):
+            FakeChannel.__init__(self, api, channel_id, None)
+    return FakeDMChannel
+
+class FakeMessage:
+    def __init__(self, api, author, channel, guild, content):
+        self.api = api
+        self.id = random.getrandbits(48)
+        self.author = author
+        self.channel = channel
+        self.guild = guild
+        self.content = content
+        self.created_at = datetime.datetime.now(datetime.timezone.utc)
+        self.reference = None
+        self.mentions = []
+
+    async def reply(self, content=None, file=None, **kwargs):
+        await self.api.call()
+        return FakeSentMessage(self.api, self.channel, content)
+
+class FakeResponse:
+    def __init__(self, interaction):
+        self.interaction = interaction
+        self.done = False
+
+    def is_done(self):
+        return self.done
+
+    async def defer(self, **kwargs):
+        await self.interaction.api.call()
+        self.done = True
+
+    async def send_message(self, content=None, embed=None, **kwargs):
+        await self.interaction.api.call()
+        self.done = True
+        self.interaction.finish(content)
+
+class FakeFollowup:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def send(self, content=None, embed=None, wait=False, **kwargs):
+        await self.interaction.api.call()
+        self.interaction.finish(content)
+        return FakeSentMessage(self.interaction.api, None, content, embed)
+
+# Progress messages /imgen shows before the job is done
+imgen_progress_prefixes = ("🎨", "⏳", "🕒")
+
+class FakeInteraction:
+    def __init__(self, api, user, guild_id, command_name):
+        self.api = api
+        self.user = user
+        self.guild_id = guild_id
+        self.guild = SimpleNamespace(id=guild_id, name="Load Test", shard_id=0)
+        self.channel = FakeChannel(api, random.getrandbits(48), "commands")
+        self.created_at = datetime.datetime.now(datetime.timezone.utc)
+        self.command = SimpleNamespace(qualified_name=command_name)
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+        self.finished = asyncio.Event()
+        self.error = None
+
+    # /imgen finishes in the background: once its progress message is replaced with the image or an error
+    def finish(self, content=None):
+        if isinstance(content, str) and content.startswith(imgen_progress_prefixes):
+            return
+        self.finished.set()
+
+    async def edit_original_response(self, content=None, embed=None, attachments=None, **kwargs):
+        await self.api.call()
+        if embed is not None or content is not None:
+            self.finish(content)
+        return FakeSentMessage(self.api, self.channel, content, embed)
+
+# --- Load generation ---
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+class LoadTest:
+    def __init__(self, bot, args, mix):
+        self.bot = bot
+        self.args = args
+        self.mix = mix
+        self.api = FakeDiscordApi(args.discord_latency)
+        self.dm_channel_class = make_dm_channel_class(bot.discord)
+        self.guild = SimpleNamespace(id=1, name="Load Test", shard_id=0)
+        self.questions = make_questions(args.distinct_questions)
+        self.latencies = {name: [] for name in mix}
+        self.failures = {name: 0 for name in mix}
+        self.lag_samples = []
+        self.message_done = {}  # message id -> asyncio.Event set once its batch was answered
+
+    # Wrap the client's batch handler to know when each chat message has been answered
+    def instrument_chat(self):
+        reply_to_batch = self.bot.client.reply_to_batch
+
+        async def instrumented(routes, commit):
+            try:
+                await reply_to_batch(routes, commit)
+            finally:
+                for route in routes:
+                    done = self.message_done.get(route.message.id)
+                    if done is not None:
+                        done.set()
+
+        self.bot.client.reply_to_batch = instrumented
+
+    async def sample_loop_lag(self, interval=0.05):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + interval
+            await asyncio.sleep(interval)
+            self.lag_samples.append(max(0.0, loop.time() - expected))
+
+    async def chat(self, kind, user):
+        if kind == "dm":
+            channel, guild, content = self.dm_channel_class(self.api, user.id), None, random.choice(self.questions)
+        elif kind == "airi":
+            channel, guild, content = FakeChannel(self.api, 10, "airi-chat"), self.guild, random.choice(self.questions)
+        else:
+            channel, guild, content = FakeChannel(self.api, 11, "general"), self.guild, "." + random.choice(self.questions)
+
+        message = FakeMessage(self.api, user, channel, guild, content)
+        done = self.message_done[message.id] = asyncio.Event()
+        try:
+            await self.bot.client.on_message(message)
+            await asyncio.wait_for(done.wait(), self.args.timeout)
+        finally:
+            self.message_done.pop(message.id, None)
+
+    # Slash commands are done when their callback returns, except /imgen which finishes on the job queue
+    async def command(self, kind, user):
+        bot = self.bot
+        interaction = FakeInteraction(self.api, user, self.guild.id, kind)
+        if kind == "tlme":
+            await bot.tlme_command.callback(interaction, random.choice(self.questions))
+        elif kind == "weather":
+            await bot.weather_command.callback(interaction, random.choice(cities))
+        elif kind == "meme":
+            await random.choice([bot.meme_command.callback, bot.cat_command.callback, bot.dog_command.callback])(interaction)
+        elif kind == "imgen":
+            await bot.imgen_command.callback(interaction, "a cat riding a skateboard")
+            await asyncio.wait_for(interaction.finished.wait(), self.args.timeout)
+
+    async def one_request(self, kind):
+        user = FakeUser(random.randrange(1, self.args.users + 1))
+        started = time.perf_counter()
+        try:
+            if kind in ("dm", "airi", "prefix"):
+                await self.chat(kind, user)
+            else:
+                await self.command(kind, user)
+        except Exception as e:
+            self.failures[kind] += 1
+            if self.failures[kind] <= 3:
+                print(f"  {kind} request failed: {type(e).__name__}: {e}", file=sys.stderr)
+        else:
+            self.latencies[kind].append(time.perf_counter() - started)
+
+    async def run(self):
+        kinds = random.choices(list(self.mix), weights=list(self.mix.values()), k=self.args.requests)
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+
+        async def limited(kind):
+            async with semaphore:
+                await self.one_request(kind)
+
+        lag_task = asyncio.create_task(self.sample_loop_lag())
+        started = time.perf_counter()
+        await asyncio.gather(*(limited(kind) for kind in kinds))
+        elapsed = time.perf_counter() - started
+        lag_task.cancel()
+        return elapsed
+
+    def report(self, elapsed):
+        completed = sum(len(values) for values in self.latencies.values())
+        failed = sum(self.failures.values())
+        print(f"\n{completed} requests completed, {failed} failed in {elapsed:.2f}s "
+              f"({completed / elapsed:.1f} requests/s, concurrency {self.args.concurrency})")
+        print(f"Fake Discord API calls: {self.api.calls}\n")
+
+        print(f"  {'scenario':<10} {'count':>6} {'failed':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}")
+        for kind, values in self.latencies.items():
+            values = sorted(values)
+            if not values and not self.failures[kind]:
+                continue
+            print(
+                f"  {kind:<10} {len(values):>6} {self.failures[kind]:>6} "
+                f"{percentile(values, 0.5):>7.3f}s {percentile(values, 0.95):>7.3f}s "
+                f"{percentile(values, 0.99):>7.3f}s {(values[-1] if values else 0):>7.3f}s"
+            )
+
+        lag = sorted(self.lag_samples)
+        print(
+            f"\nEvent loop lag: p50 {percentile(lag, 0.5) * 1000:.1f}ms, p95 {percentile(lag, 0.95) * 1000:.1f}ms, "
+            f"p99 {percentile(lag, 0.99) * 1000:.1f}ms, max {(lag[-1] if lag else 0) * 1000:.1f}ms"
+        )
+
+        states = ", ".join(f"{name} {breaker.state}" for name, breaker in self.bot.circuit_breakers.items())
+        print(f"Circuit breakers: {states}")
+        print(
+            f"Caches: conversation {self.bot.conversation_cache.hits} hits/{self.bot.conversation_cache.misses} misses, "
+            f"tlme {self.bot.tlme_cache.hits + self.bot.tlme_cache.similar_hits} hits/{self.bot.tlme_cache.misses} misses, "
+            f"weather {self.bot.weather_client.hits} hits/{self.bot.weather_client.misses} misses"
+        )
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in default_mix:
+            raise SystemExit(f"Unknown scenario {name!r}; choose from {', '.join(default_mix)}")
+        mix[name] = float(weight or 1)
+    return {name: weight for name, weight in mix.items() if weight > 0}
+
+async def run_load_test(bot, args, mix):
+    backends, base_url = await start_fake_backends(args)
+    bot.HUGGINGFACE_API_URL = f"{base_url}/huggingface"
+    bot.OPENWEATHER_API_URL = f"{base_url}/weather"
+    bot.MEME_API_URL = f"{base_url}/gimme"
+    bot.CAT_API_URL = f"{base_url}/cat"
+    bot.DOG_API_URL = f"{base_url}/dog"
+    bot.gemini_engine.model = FakeGeminiModel(args.gemini_latency, args.gemini_error_rate, args.stream_chunks, args.reply_chars)
+
+    # Start the bot the way MyClient.setup_hook does, without logging in or syncing commands
+    client = bot.client
+    await client.start_services()
+
+    test = LoadTest(bot, args, mix)
+    test.instrument_chat()
+    try:
+        elapsed = await test.run()
+        test.report(elapsed)
+        bot.watchdog.report()
+        if args.metrics:
+            with open(args.metrics, "w", encoding="utf-8") as file:
+                file.write(bot.metrics.render())
+            print(f"Metrics written to {args.metrics}")
+    finally:
+        await client.stop_tasks()
+        await client.stop_services()
+        await backends.cleanup()
+
+def main():
+    args = parse_args()
+    mix = parse_mix(args.mix)
+    random.seed(args.seed)
+
+    with tempfile.TemporaryDirectory(prefix="bot-loadtest-") as data_dir:
+        configure_environment(args, data_dir)
+        import bot
+
+        print(f"Load test: {args.requests} requests, concurrency {args.concurrency}, mix {mix}")
+        asyncio.run(run_load_test(bot, args, mix))
+
+if __name__ == "__main__":
+    main()